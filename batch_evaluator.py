@@ -0,0 +1,121 @@
+import sys
+from itertools import islice
+
+import numpy as np
+
+from evaluator import Evaluator
+from piece_types import CHAR_TO_PIECE, Color, Piece
+from bitboard import BOARD_SIZE, SQUARE_NB, to_square
+
+# 多数の局面を NumPy の配列にまとめて、Evaluator.evaluate と同じ評価値をまとめて計算する
+# 局面は次の配列で表す
+#   board: [局面][マス] 駒 (Piece の値)
+#   hand : [局面][駒] 持ち駒の枚数
+#   side : [局面] 手番 (Color の値)
+
+DEFAULT_CHUNK_SIZE = 65536  # 一度に配列にする局面数
+
+# [駒] 駒の価値
+PIECE_VALUE_TABLE = np.array(
+    [Evaluator.PIECE_VALUES[Piece(piece)] for piece in range(Piece.NUM_PIECES)],
+    dtype=np.int64,
+)
+
+
+def encode_sfen(sfen: str, board, hand) -> int:
+    """SFEN 文字列の盤面と持ち駒を 1 局面分の配列に書き込み、手番を返す"""
+    fields = sfen.split()
+    file = BOARD_SIZE - 1
+    rank = 0
+    promotion = False
+    for c in fields[0]:
+        if c == "/":
+            file = BOARD_SIZE - 1
+            rank += 1
+        elif c == "+":
+            promotion = True
+        elif c.isdigit():
+            file -= int(c)
+        else:
+            piece = CHAR_TO_PIECE[c]
+            if promotion:
+                piece = piece.as_promoted()
+                promotion = False
+            board[to_square(file, rank)] = piece
+            file -= 1
+
+    count = 0
+    for c in fields[2]:
+        if c == "-":
+            continue
+        if c.isdigit():
+            count = count * 10 + int(c)
+            continue
+        hand[CHAR_TO_PIECE[c]] = max(1, count)
+        count = 0
+
+    return Color.BLACK if fields[1] == "b" else Color.WHITE
+
+
+def encode_position(position, board, hand) -> int:
+    """Position の盤面と持ち駒を 1 局面分の配列に書き込み、手番を返す"""
+    for square in range(SQUARE_NB):
+        board[square] = position.board[square // BOARD_SIZE][square % BOARD_SIZE]
+    hand[:] = position.hand_piece
+    return position.side_to_move
+
+
+def encode(positions):
+    """SFEN 文字列か Position のリストを (board, hand, side) の配列にする"""
+    num_positions = len(positions)
+    board = np.zeros((num_positions, SQUARE_NB), dtype=np.uint8)
+    hand = np.zeros((num_positions, Piece.NUM_PIECES), dtype=np.uint8)
+    side = np.zeros(num_positions, dtype=np.uint8)
+    for i, position in enumerate(positions):
+        if isinstance(position, str):
+            side[i] = encode_sfen(position, board[i], hand[i])
+        else:
+            side[i] = encode_position(position, board[i], hand[i])
+    return board, hand, side
+
+
+def evaluate_encoded(board, hand, side):
+    """配列にした局面の評価値 (手番側から見たもの) をまとめて計算する"""
+    value = PIECE_VALUE_TABLE[board].sum(axis=1)
+    value += hand.astype(np.int64) @ PIECE_VALUE_TABLE
+    return np.where(side == Color.WHITE, -value, value)
+
+
+def evaluate_batch(positions):
+    """SFEN 文字列か Position のリストの評価値をまとめて計算する"""
+    return evaluate_encoded(*encode(positions))
+
+
+def evaluate_stream(positions, chunk_size=DEFAULT_CHUNK_SIZE):
+    """SFEN 文字列か Position を chunk_size 局面ずつ評価し、評価値の配列を順に返す
+
+    入力はイテレータでよく、一度に chunk_size 局面分しかメモリに載せない。
+    """
+    iterator = iter(positions)
+    while True:
+        chunk = list(islice(iterator, chunk_size))
+        if not chunk:
+            break
+        yield evaluate_batch(chunk)
+
+
+def main():
+    """1 行 1 局面の SFEN ファイルを読み、評価値を 1 行ずつ出力する
+
+    python batch_evaluator.py positions.sfen [chunk_size] > scores.txt
+    """
+    path = sys.argv[1]
+    chunk_size = int(sys.argv[2]) if len(sys.argv) >= 3 else DEFAULT_CHUNK_SIZE
+    with open(path, encoding="utf-8") as f:
+        sfens = (line.strip() for line in f if line.strip())
+        for values in evaluate_stream(sfens, chunk_size):
+            sys.stdout.write("\n".join(map(str, values.tolist())) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+import argparse
+import json
+import sys
+import time
+
+from position import Position
+from generate import generate
+from evaluator import Evaluator
+from searcher import Searcher
+from transposition_table import TranspositionTable
+from time_manager import SearchLimits, TimeManager
+
+# ベンチマークに使う局面 (序盤、中盤、終盤、詰将棋風)
+BENCH_SFENS = [
+    "lnsgkgsnl/1r5b1/ppppppppp/9/9/9/PPPPPPPPP/1B5R1/LNSGKGSNL b - 1",
+    "ln1g3nl/1r1sk1g2/p1pppsbpp/1p3pp2/7P1/2P1P4/PPBP1PP1P/2GS3R1/LN2KGSNL b - 1",
+    "l6nl/5+P1gk/2np1S3/p1p4Pp/3P2Sp1/1PPb2P1P/P5GS1/R8/LN4bKL w RGgsn5p 1",
+    "lr6l/4g1k1p/1s1p1pgp1/p3P1N1P/2Pl5/PPbBSP3/6PP1/4S1SK1/1+r3G1NL b N3Pgs 1",
+    "8l/1l+R2P3/p2pBG1pp/kps1p4/Nn1P2G2/P1P1P2PP/1PS6/1KSG3+r1/LN2+p3L w Sbgn3p 124",
+    "4k4/9/4P4/9/9/9/9/9/4K4 b G2r2b3g4s4n4l17p 1",
+]
+
+DEFAULT_DEPTH = 3  # 探索のベンチマークの深さ
+MICRO_ITERATIONS = 200  # マイクロベンチマークで 1 局面あたり何回ずつ呼ぶか
+
+
+def bench_search(positions, depth=DEFAULT_DEPTH, nodes=None):
+    """各局面を決まった深さ (または局面数) まで探索し、合計の局面数と時間を返す
+
+    depth が None なら局面数の上限 nodes に達するまで深くする
+
+    局面ごとに置換表を空にするので、同じ深さなら何度実行しても同じ局面数になる
+    """
+    tt = TranspositionTable()
+    searcher = Searcher(tt)
+    total_nodes = 0
+    start_time = time.perf_counter()
+    for position in positions:
+        tt.clear()
+        limits = SearchLimits()
+        limits.depth = depth
+        limits.nodes = nodes
+        for _ in searcher.iterative_deepening(
+            position, limits, TimeManager(limits, position.side_to_move)
+        ):
+            pass
+        total_nodes += searcher.nodes
+    return total_nodes, time.perf_counter() - start_time
+
+
+def _measure(function, positions, iterations):
+    """function(position) を各局面で iterations 回ずつ呼び、1 回あたりの秒数を返す"""
+    start_time = time.perf_counter()
+    for position in positions:
+        for _ in range(iterations):
+            function(position)
+    return (time.perf_counter() - start_time) / (len(positions) * iterations)
+
+
+def _do_undo_all(position):
+    for move in generate(position):
+        position.do_move(move)
+        position.undo_move(move)
+
+
+def bench_micro(positions, iterations=MICRO_ITERATIONS):
+    """探索中によく呼ばれる関数を個別に計測し、{名前: 1 秒あたりの呼び出し回数} を返す"""
+    num_moves = sum(len(generate(position)) for position in positions)
+    timings = {
+        "generate": _measure(generate, positions, iterations),
+        "do_undo": _measure(_do_undo_all, positions, iterations)
+        * len(positions)
+        / num_moves,
+        "is_in_checked": _measure(
+            lambda position: position.is_in_checked(), positions, iterations
+        ),
+        "evaluate": _measure(Evaluator.evaluate, positions, iterations),
+    }
+    return {name: int(1 / seconds) for name, seconds in timings.items()}
+
+
+def run(depth=None, nodes=None, json_path=None, output=print):
+    """ベンチマークを実行して結果を出力し、結果の dict を返す
+
+    depth も nodes も指定しなければ DEFAULT_DEPTH まで、nodes だけなら局面数の上限まで探索する
+    """
+    if depth is None and nodes is None:
+        depth = DEFAULT_DEPTH
+    positions = []
+    for sfen in BENCH_SFENS:
+        position = Position()
+        position.set_position(sfen)
+        positions.append(position)
+
+    search_nodes, elapsed = bench_search(positions, depth, nodes)
+    nps = int(search_nodes / elapsed) if elapsed > 0 else 0
+    micro = bench_micro(positions)
+
+    for name, calls_per_second in micro.items():
+        output(f"{name}: {calls_per_second} calls/s")
+    output(f"nodes {search_nodes} time {int(elapsed * 1000)} nps {nps}")
+
+    result = {
+        "depth": depth,
+        "nodes_limit": nodes,
+        "nodes": search_nodes,
+        "time_ms": int(elapsed * 1000),
+        "nps": nps,
+        "micro": micro,
+    }
+    if json_path is not None:
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+    return result
+
+
+def main():
+    """コマンドラインからベンチマークを実行する
+
+    python bench.py --depth 3 --json result.json
+    """
+    parser = argparse.ArgumentParser(description="探索と合法手生成などのベンチマーク")
+    parser.add_argument(
+        "--depth", type=int, default=None, help=f"省略時は {DEFAULT_DEPTH} (--nodes だけなら制限なし)"
+    )
+    parser.add_argument("--nodes", type=int, default=None)
+    parser.add_argument("--json", default=None, help="結果を書き出す JSON ファイル")
+    args = parser.parse_args()
+    run(args.depth, args.nodes, args.json)
+    sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
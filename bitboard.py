@@ -0,0 +1,42 @@
+# 盤面を 81 ビットの整数で表すビットボード
+# マス番号は square = file * 9 + rank (file, rank は 0 始まり)
+
+BOARD_SIZE = 9  # 盤面の一辺のマス数
+SQUARE_NB = BOARD_SIZE * BOARD_SIZE  # 盤面のマス数
+
+
+def to_square(file: int, rank: int) -> int:
+    return file * BOARD_SIZE + rank
+
+
+# マス番号から筋・段を引く表
+SQUARE_FILE = [square // BOARD_SIZE for square in range(SQUARE_NB)]
+SQUARE_RANK = [square % BOARD_SIZE for square in range(SQUARE_NB)]
+
+# 各マスだけが立っているビットボード
+SQUARE_BB = [1 << square for square in range(SQUARE_NB)]
+
+# 全マスが立っているビットボード
+ALL_BB = (1 << SQUARE_NB) - 1
+
+# 各筋・各段のビットボード
+FILE_BB = [
+    sum(SQUARE_BB[to_square(file, rank)] for rank in range(BOARD_SIZE))
+    for file in range(BOARD_SIZE)
+]
+RANK_BB = [
+    sum(SQUARE_BB[to_square(file, rank)] for file in range(BOARD_SIZE))
+    for rank in range(BOARD_SIZE)
+]
+
+
+def iter_squares(bb: int):
+    """ビットボードの立っているマス番号を小さい順に列挙する"""
+    while bb:
+        lsb = bb & -bb
+        yield lsb.bit_length() - 1
+        bb ^= lsb
+
+
+def pop_count(bb: int) -> int:
+    return bb.bit_count()
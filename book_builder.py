@@ -0,0 +1,294 @@
+import argparse
+import collections
+import heapq
+import multiprocessing
+import os
+import struct
+import sys
+import tempfile
+
+from position import Position
+from generate import generate_legal
+from move import move_from_usi_string
+from opening_book import BOOK_RECORD
+
+# 途中経過のチャンクファイルのレコード (ハッシュキー, 指し手, 出現回数)
+# ハッシュキーと指し手の昇順に並べ、同じ組は 1 レコードにまとめておく
+CHUNK_RECORD = struct.Struct("<QHI")
+
+DEFAULT_MAX_PLY = 32  # 何手目までの局面を定跡にするか
+DEFAULT_GAMES_PER_CHUNK = 10000  # 1 つのチャンクファイルにまとめる対局数
+MAX_MERGE_FILES = 64  # 一度にマージするチャンクファイルの数
+READ_BUFFER_RECORDS = 4096  # チャンクファイルを一度に読むレコード数
+
+# CSA 形式の駒の名前 -> USI 形式の駒打ちの文字
+CSA_DROP_PIECES = {
+    "FU": "P",
+    "KY": "L",
+    "KE": "N",
+    "GI": "S",
+    "KI": "G",
+    "KA": "B",
+    "HI": "R",
+}
+CSA_PROMOTED_PIECES = {"TO", "NY", "NK", "NG", "UM", "RY"}
+
+
+def csa_move_to_usi(position, csa_move: str) -> str:
+    """CSA 形式の指し手 (+7776FU など) を USI 形式の文字列に変換する"""
+    file_from = int(csa_move[1])
+    rank_from = int(csa_move[2])
+    square_to = f"{csa_move[3]}{chr(ord('a') + int(csa_move[4]) - 1)}"
+    piece = csa_move[5:7]
+    if file_from == 0:
+        return f"{CSA_DROP_PIECES[piece]}*{square_to}"
+    usi_move = f"{file_from}{chr(ord('a') + rank_from - 1)}{square_to}"
+    if (
+        piece in CSA_PROMOTED_PIECES
+        and position.board[file_from - 1][rank_from - 1].can_promote()
+    ):
+        usi_move += "+"
+    return usi_move
+
+
+def _usi_game_moves(position, line: str):
+    """USI の position コマンドの形式の 1 行から局面を設定し、指し手の文字列を返す"""
+    tokens = line.split()
+    if tokens and tokens[0] == "position":
+        tokens = tokens[1:]
+    if not tokens:
+        return None
+    if tokens[0] == "startpos":
+        position.set_position(Position.start_position_sfen)
+        tokens = tokens[1:]
+    elif tokens[0] == "sfen" and len(tokens) >= 5:
+        position.set_position(" ".join(tokens[1:5]))
+        tokens = tokens[5:]
+    else:
+        return None
+    if tokens and tokens[0] == "moves":
+        tokens = tokens[1:]
+    return tokens
+
+
+def _csa_game_moves(position, text: str):
+    """CSA 形式の 1 局から局面を設定し、指し手の文字列を返す (平手の対局のみ)"""
+    moves = []
+    hirate = False
+    for line in text.splitlines():
+        # 1 行に複数の文を "," で区切って書ける
+        for statement in line.strip().split(","):
+            if statement == "PI":
+                hirate = True
+            elif len(statement) >= 7 and statement[0] in "+-" and statement[1].isdigit():
+                moves.append(statement)
+    if not hirate:
+        return None
+    position.set_position(Position.start_position_sfen)
+    return moves
+
+
+def _replay(position, game, max_ply, counts) -> None:
+    """1 局を再生し、max_ply 手目までの (局面のハッシュキー, 指し手) を数える"""
+    kind, text = game
+    if kind == "csa":
+        move_strings = _csa_game_moves(position, text)
+    else:
+        move_strings = _usi_game_moves(position, text)
+    if move_strings is None:
+        return
+    for move_string in move_strings[:max_ply]:
+        if kind == "csa":
+            move_string = csa_move_to_usi(position, move_string)
+        move = move_from_usi_string(position, move_string)
+        if move not in generate_legal(position):
+            # 棋譜が壊れているので、ここまでを使う
+            return
+        counts[(position.key, move)] += 1
+        position.do_move(move)
+
+
+def _write_chunk(path, records) -> None:
+    """(ハッシュキー, 指し手, 出現回数) の昇順のイテレータをチャンクファイルに書き出す"""
+    with open(path, "wb") as f:
+        buffer = []
+        for record in records:
+            buffer.append(CHUNK_RECORD.pack(*record))
+            if len(buffer) >= READ_BUFFER_RECORDS:
+                f.write(b"".join(buffer))
+                buffer = []
+        f.write(b"".join(buffer))
+
+
+def _read_chunk(path):
+    """チャンクファイルのレコードを先頭から順に返す"""
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(CHUNK_RECORD.size * READ_BUFFER_RECORDS)
+            if not data:
+                break
+            yield from CHUNK_RECORD.iter_unpack(data)
+
+
+def _build_chunk(job):
+    """プロセスプールで対局をまとめて再生し、数えた結果をチャンクファイルに書き出す"""
+    games, path, max_ply = job
+    position = Position()
+    counts = collections.Counter()
+    for game in games:
+        try:
+            _replay(position, game, max_ply, counts)
+        except (AssertionError, IndexError, KeyError, ValueError):
+            # 読めない棋譜は飛ばす
+            continue
+    _write_chunk(path, ((key, move, n) for (key, move), n in sorted(counts.items())))
+    return path
+
+
+def _merge_counts(paths):
+    """チャンクファイルをマージし、同じ (ハッシュキー, 指し手) の出現回数を足して返す"""
+    current = None
+    for key, move, count in heapq.merge(*(_read_chunk(path) for path in paths)):
+        if current is not None and current[0] == key and current[1] == move:
+            current[2] += count
+            continue
+        if current is not None:
+            yield tuple(current)
+        current = [key, move, count]
+    if current is not None:
+        yield tuple(current)
+
+
+def read_games(paths):
+    """入力ファイルから 1 局ずつ ("csa" か "usi", 棋譜の文字列) を返す
+
+    .csa のファイルは "/" の行で区切られた対局を、それ以外は 1 行 1 局の USI 形式として読む
+    """
+    for path in paths:
+        with open(path, encoding="utf-8", errors="replace") as f:
+            if path.lower().endswith(".csa"):
+                lines = []
+                for line in f:
+                    if line.strip() == "/":
+                        yield ("csa", "".join(lines))
+                        lines = []
+                    else:
+                        lines.append(line)
+                if lines:
+                    yield ("csa", "".join(lines))
+            else:
+                for line in f:
+                    if line.strip():
+                        yield ("usi", line)
+
+
+def _batches(games, size):
+    batch = []
+    for game in games:
+        batch.append(game)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def build_book(
+    input_paths,
+    output_path,
+    max_ply=DEFAULT_MAX_PLY,
+    min_count=1,
+    processes=1,
+    games_per_chunk=DEFAULT_GAMES_PER_CHUNK,
+    temp_dir=None,
+    output=print,
+):
+    """棋譜から定跡ファイルを作る
+
+    対局を games_per_chunk 局ずつプロセスプールで再生してソート済みのチャンクファイルに書き、
+    それを外部マージソートでまとめるので、メモリに載らない量の棋譜でも扱える
+    """
+    with tempfile.TemporaryDirectory(dir=temp_dir) as work_dir:
+        chunk_paths = []
+        jobs = (
+            (games, os.path.join(work_dir, f"chunk{i}.bin"), max_ply)
+            for i, games in enumerate(_batches(read_games(input_paths), games_per_chunk))
+        )
+        with multiprocessing.get_context("spawn").Pool(processes) as pool:
+            pending = collections.deque()
+            for job in jobs:
+                pending.append(pool.apply_async(_build_chunk, (job,)))
+                # 読み込んだ棋譜がメモリにたまらないよう、処理待ちの数を抑える
+                while len(pending) >= processes * 2:
+                    chunk_paths.append(pending.popleft().get())
+            while pending:
+                chunk_paths.append(pending.popleft().get())
+        output(f"info string {len(chunk_paths)} chunks")
+
+        # 開けるファイル数に収まるまで、チャンクファイルを少しずつマージする
+        generation = 0
+        while len(chunk_paths) > MAX_MERGE_FILES:
+            merged_paths = []
+            for i in range(0, len(chunk_paths), MAX_MERGE_FILES):
+                group = chunk_paths[i : i + MAX_MERGE_FILES]
+                path = os.path.join(work_dir, f"merge{generation}_{i}.bin")
+                _write_chunk(path, _merge_counts(group))
+                for chunk_path in group:
+                    os.remove(chunk_path)
+                merged_paths.append(path)
+            chunk_paths = merged_paths
+            generation += 1
+
+        num_positions = 0
+        num_records = 0
+        with open(output_path, "wb") as f:
+            key_records = []
+            for key, move, count in _merge_counts(chunk_paths):
+                if key_records and key_records[0][0] != key:
+                    num_positions += 1
+                    num_records += _write_position(f, key_records)
+                    key_records = []
+                if count >= min_count:
+                    key_records.append((key, move, min(count, 0xFFFFFFFF), 0))
+            if key_records:
+                num_positions += 1
+                num_records += _write_position(f, key_records)
+    output(f"info string {num_positions} positions {num_records} moves")
+    return num_records
+
+
+def _write_position(f, key_records) -> int:
+    """1 局面分のレコードを重みの大きい順に書き出す"""
+    key_records.sort(key=lambda record: -record[2])
+    f.write(b"".join(BOOK_RECORD.pack(*record) for record in key_records))
+    return len(key_records)
+
+
+def main():
+    """棋譜から定跡ファイルを作る
+
+    python book_builder.py games.txt kifu/*.csa -o book.bin --max-ply 32 --processes 4
+    """
+    parser = argparse.ArgumentParser(description="棋譜から定跡ファイルを作る")
+    parser.add_argument("inputs", nargs="+", help="USI の position 形式の棋譜か CSA ファイル")
+    parser.add_argument("-o", "--output", default="book.bin")
+    parser.add_argument("--max-ply", type=int, default=DEFAULT_MAX_PLY)
+    parser.add_argument("--min-count", type=int, default=1, help="定跡に入れる最小の出現回数")
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--games-per-chunk", type=int, default=DEFAULT_GAMES_PER_CHUNK)
+    parser.add_argument("--temp-dir", default=None, help="チャンクファイルを置くディレクトリ")
+    args = parser.parse_args()
+    build_book(
+        args.inputs,
+        args.output,
+        args.max_ply,
+        args.min_count,
+        args.processes,
+        args.games_per_chunk,
+        args.temp_dir,
+    )
+    sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
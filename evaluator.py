@@ -1,4 +1,5 @@
 from piece_types import Color, Piece
+from bitboard import pop_count
 
 
 class Evaluator:
@@ -34,18 +35,29 @@ class Evaluator:
         Piece.WHITE_DRAGON: -1395,
     }
 
+    # True にすると evaluate のたびに差分更新した駒割りを一から計算し直したものと照合する
+    # (デバッグ用)
+    DEBUG_INCREMENTAL = False
+
     @staticmethod
-    def evaluate(position):
+    def compute_material(position):
+        """先手から見た駒割りを一から計算する"""
         value = 0
 
-        # 盤上の駒の評価値を合算
-        for board_row in position.board:
-            for piece in board_row:
-                value += Evaluator.PIECE_VALUES[piece]
+        for piece, piece_value in Evaluator.PIECE_VALUES.items():
+            # 盤上の駒の評価値を駒種ごとのビットボードから合算
+            value += piece_value * pop_count(position.piece_bb[piece])
+            # 持ち駒の評価値を合算
+            value += piece_value * position.hand_piece[piece]
+
+        return value
 
-        # 持ち駒の評価値を合算
-        for piece_type, num_piece in enumerate(position.hand_piece):
-            value += Evaluator.PIECE_VALUES[Piece(piece_type)] * num_piece
+    @staticmethod
+    def evaluate(position):
+        # 駒割りは Position が do_move/undo_move で差分更新している
+        value = position.material
+        if Evaluator.DEBUG_INCREMENTAL:
+            assert value == Evaluator.compute_material(position), "駒割りが一致しません"
 
         # 後手の場合は評価値を反転
         if position.side_to_move == Color.WHITE:
@@ -1,146 +1,343 @@
-from position import Position
+from position import BETWEEN_BB, MOVE_RAYS, SQUARE_JUMPS, SQUARE_RAYS, Position
 from piece_types import Piece, Color
-from move import Move
+from move import DROP_PIECES, MOVE_FROM_SHIFT, MOVE_PROMOTE, MOVE_TO_MASK, make_drop
+from bitboard import ALL_BB, FILE_BB, SQUARE_BB, SQUARE_FILE, SQUARE_NB, SQUARE_RANK
+from bitboard import iter_squares
 
-
-def is_pawn_exist(board, file, pawn) -> bool:
-    for rank in range(Position.BOARD_SIZE):
-        if board[file][rank] == pawn:
-            return True
-    return False
+# 成れる駒かどうか [駒]
+CAN_PROMOTE = [
+    piece != Piece.NO_PIECE and Piece(piece).can_promote()
+    for piece in range(Piece.NUM_PIECES)
+]
+# 成らずにその段に動けるかどうか [駒][段]
+CAN_MOVE_WITHOUT_PROMOTION = [
+    [
+        piece != Piece.NO_PIECE and Piece(piece).can_put_without_promotion(rank)
+        for rank in range(Position.BOARD_SIZE)
+    ]
+    for piece in range(Piece.NUM_PIECES)
+]
+# 成らずに打てるマス (行き所のない段を除いたマス) のビットボード [駒]
+DROP_TARGET_BB = [
+    sum(
+        SQUARE_BB[square]
+        for square in range(SQUARE_NB)
+        if CAN_MOVE_WITHOUT_PROMOTION[piece][SQUARE_RANK[square]]
+    )
+    for piece in range(Piece.NUM_PIECES)
+]
+# 筋のマスク (bit n が n 筋目) に含まれる筋のビットボード [マスク]
+FILES_MASK_BB = [
+    sum(FILE_BB[file] for file in range(Position.BOARD_SIZE) if (mask >> file) & 1)
+    for mask in range(1 << Position.BOARD_SIZE)
+]
+# 成った後の駒 [駒] (成れない駒はそのまま)
+PROMOTED_PIECE = [
+    Piece(piece).as_promoted() if CAN_PROMOTE[piece] else piece
+    for piece in range(Piece.NUM_PIECES)
+]
+# 持ち駒の種類の数 (歩から飛車まで)
+DROP_PIECE_TYPES = Piece.BLACK_ROOK - Piece.BLACK_PAWN + 1
+# 手番ごとの駒の種類の数 (歩から竜まで)
+PIECE_TYPES = Piece.WHITE_PAWN - Piece.BLACK_PAWN
+# 敵陣かどうか [手番][段]
+PROMOTION_RANKS = [
+    [rank <= 2 for rank in range(Position.BOARD_SIZE)],
+    [rank >= 6 for rank in range(Position.BOARD_SIZE)],
+]
 
 
 # 指し手生成関数
-def generate(position):
+# 整数で表した指し手のリストを、駒を取る指し手、駒を取らない成る指し手、
+# 駒を取らない成らない指し手、駒を打つ指し手の順に返す
+# target を指定すると、移動先がそのビットボードに含まれる指し手だけを返す
+# sources を指定すると、そのビットボードのマスにある駒を動かす指し手だけを返す (駒打ちは含めない)
+def generate(position, target=ALL_BB, sources=None):
     side_to_move = position.side_to_move
     board = position.board
     hand_pieces = position.hand_piece
+    own_bb = position.color_bb[side_to_move]
+    capture_moves = []
     non_capture_promotion_moves = []
     non_capture_non_promotion_moves = []
 
-    # 駒を移動する指し手
-    for file_from in range(Position.BOARD_SIZE):
-        for rank_from in range(Position.BOARD_SIZE):
-            piece_from = board[file_from][rank_from]
-            if piece_from == Piece.NO_PIECE:
-                # 駒がないので何もしない
+    # 駒を移動する指し手 (手番の駒があるマスだけを調べる)
+    occupied = position.occupied
+    promotion_ranks = PROMOTION_RANKS[side_to_move]
+    for square_from in iter_squares(own_bb if sources is None else own_bb & sources):
+        piece_from = board[SQUARE_FILE[square_from]][SQUARE_RANK[square_from]]
+        move_from = square_from << MOVE_FROM_SHIFT
+        can_promote = CAN_PROMOTE[piece_from]
+        from_promotion_rank = promotion_ranks[SQUARE_RANK[square_from]]
+        can_move_without_promotion = CAN_MOVE_WITHOUT_PROMOTION[piece_from]
+
+        # 方向ごとに、盤内の移動先を近い順にたどる
+        for ray in MOVE_RAYS[piece_from][square_from]:
+            for square_to in ray:
+                bb = SQUARE_BB[square_to]
+                if own_bb & bb:
+                    # 自分の駒があるので何もしない
+                    break
+                is_capture = occupied & bb
+
+                if not target & bb:
+                    # 移動先が対象外
+                    if is_capture:
+                        break
+                    continue
+
+                rank_to = SQUARE_RANK[square_to]
+                # 成る指し手
+                if can_promote and (from_promotion_rank or promotion_ranks[rank_to]):
+                    move = move_from | square_to | MOVE_PROMOTE
+                    if is_capture:
+                        # 駒を取る指し手
+                        capture_moves.append(move)
+                    else:
+                        # 駒を取らない指し手
+                        non_capture_promotion_moves.append(move)
+
+                # 成らない指し手
+                if can_move_without_promotion[rank_to]:
+                    move = move_from | square_to
+                    if is_capture:
+                        # 駒を取る指し手
+                        capture_moves.append(move)
+                    else:
+                        # 駒を取らない指し手
+                        non_capture_non_promotion_moves.append(move)
+
+                if is_capture:
+                    # 相手の駒があるのでここで利きが止まる
+                    break
+
+    # 駒を取る指し手、駒を取らない成る指し手、駒を取らない成らない指し手の順に並べる
+    moves = capture_moves
+    moves += non_capture_promotion_moves
+    moves += non_capture_non_promotion_moves
+
+    # 駒を打つ指し手 (空いているマスのうち、行き所のある段だけを調べる)
+    empty_bb = target & ~position.occupied
+    if not empty_bb or sources is not None:
+        return moves
+    min_piece = Piece.BLACK_PAWN if side_to_move == Color.BLACK else Piece.WHITE_PAWN
+    for piece_from in range(min_piece, min_piece + DROP_PIECE_TYPES):
+        if hand_pieces[piece_from] == 0:
+            continue
+        drop_bb = empty_bb & DROP_TARGET_BB[piece_from]
+        if piece_from == min_piece:
+            # 2歩
+            drop_bb &= ~FILES_MASK_BB[position.pawn_files[side_to_move]]
+        for square_to in iter_squares(drop_bb):
+            moves.append(make_drop(piece_from, square_to))
+
+    return moves
+
+
+def _blockers(position, king_square, blocker_color, slider_color):
+    """king_square の玉と slider_color の飛び駒の間に 1 枚だけある blocker_color の駒を調べる
+
+    {その駒のマス: 玉と飛び駒の間と飛び駒のマスのビットボード} を返す。
+    blocker_color が玉の側ならピンされている駒、飛び駒の側なら動くと開き王手になる駒
+    """
+    board = position.board
+    occupied = position.occupied
+    blocker_bb = position.color_bb[blocker_color]
+    slider_bb = position.color_bb[slider_color]
+    blockers = {}
+    for ray, _, long_attackers in SQUARE_RAYS[king_square]:
+        line = 0
+        blocker_square = None
+        for square in ray:
+            bb = SQUARE_BB[square]
+            line |= bb
+            if not occupied & bb:
                 continue
-            if piece_from.to_color() != side_to_move:
-                # 手番の駒でないので何もしない
+            if blocker_square is None:
+                if not blocker_bb & bb:
+                    break
+                blocker_square = square
                 continue
+            if (
+                slider_bb & bb
+                and long_attackers[board[SQUARE_FILE[square]][SQUARE_RANK[square]]]
+            ):
+                blockers[blocker_square] = line
+            break
+    return blockers
 
-            for move_direction in piece_from.move_directions():
-                max_distance = 8 if move_direction.is_long else 1
-                file_to = file_from
-                rank_to = rank_from
-                for distance in range(max_distance):
-                    file_to += move_direction.direction.delta_file
-                    rank_to += move_direction.direction.delta_rank
-
-                    if not (
-                        0 <= file_to < Position.BOARD_SIZE
-                        and 0 <= rank_to < Position.BOARD_SIZE
-                    ):
-                        # 盤外に出たので何もしない
-                        continue
-
-                    piece_to = board[file_to][rank_to]
-                    if (
-                        piece_to != Piece.NO_PIECE
-                        and piece_to.to_color() == side_to_move
-                    ):
-                        # 自分の駒があるので何もしない
-                        break
 
-                    # 成る指し手
-                    if piece_from.can_promote() and (
-                        (side_to_move == Color.BLACK and rank_to <= 2)
-                        or (side_to_move == Color.WHITE and rank_to >= 6)
-                        or (side_to_move == Color.BLACK and rank_from <= 2)
-                        or (side_to_move == Color.WHITE and rank_from >= 6)
-                    ):
-                        move = Move(
-                            file_from,
-                            rank_from,
-                            piece_from,
-                            file_to,
-                            rank_to,
-                            piece_to,
-                            False,
-                            True,
-                            side_to_move,
-                        )
-
-                        if move.piece_to != Piece.NO_PIECE:
-                            # 駒を取る指し手
-                            yield move
-                        else:
-                            # 駒を取らない指し手
-                            non_capture_promotion_moves.append(move)
-
-                    # 成らない指し手
-                    if piece_from.can_put_without_promotion(rank_to):
-                        move = Move(
-                            file_from,
-                            rank_from,
-                            piece_from,
-                            file_to,
-                            rank_to,
-                            piece_to,
-                            False,
-                            False,
-                            side_to_move,
-                        )
-
-                        if move.piece_to != Piece.NO_PIECE:
-                            # 駒を取る指し手
-                            yield move
-                        else:
-                            # 駒を取らない指し手
-                            non_capture_non_promotion_moves.append(move)
-
-                    if piece_to != Piece.NO_PIECE:
-                        # 相手の駒があるのでここで利きが止まる
-                        break
+def _pinned_pieces(position, king_square, color):
+    """color の駒のうち、動くと玉が取られる (ピンされている) 駒を調べる
+
+    {ピンされている駒のマス: 動いてよいマス (玉と相手の駒の間と相手の駒のマス) のビットボード}
+    を返す
+    """
+    return _blockers(position, king_square, color, color.to_opponent())
+
+
+def _legal_context(position):
+    """手番側の (玉のマス, 玉以外の駒の移動先の制限, ピンされている駒) を返す
+
+    玉がない局面では玉のマスは None で、制限はない
+    """
+    side_to_move = position.side_to_move
+    king = Piece.BLACK_KING if side_to_move == Color.BLACK else Piece.WHITE_KING
+    king_bb = position.piece_bb[king]
+    if not king_bb:
+        return None, ALL_BB, {}
+
+    king_square = king_bb.bit_length() - 1
+    opponent = side_to_move.to_opponent()
+
+    # 王手している駒
+    checkers = position.attackers_to(king_square) & position.color_bb[opponent]
+    if checkers == 0:
+        target = ALL_BB
+    elif checkers & (checkers - 1) == 0:
+        # 王手している駒を取るか、間に駒を移動するか打つ
+        checker_square = checkers.bit_length() - 1
+        target = checkers | BETWEEN_BB[king_square][checker_square]
+    else:
+        # 両王手なので玉を動かすしかない
+        target = 0
 
-    # 駒を取らない、成る指し手
-    for move in non_capture_promotion_moves:
-        yield move
+    return king_square, target, _pinned_pieces(position, king_square, side_to_move)
 
-    # 駒を取らない、成らない指し手
-    for move in non_capture_non_promotion_moves:
-        yield move
 
-    # 駒を打つ指し手
+# 合法手生成関数
+# 王手や駒のピンを局面ごとに一度だけ調べ、do_move/undo_move をせずに
+# 自玉が取られる指し手を除いた指し手のリストを返す
+def generate_legal(position):
+    king_square, target, pinned = _legal_context(position)
+    if king_square is None:
+        # 玉がない局面 (詰将棋など) では全ての指し手が合法
+        return generate(position)
+
+    side_to_move = position.side_to_move
+    king = Piece.BLACK_KING if side_to_move == Color.BLACK else Piece.WHITE_KING
+    opponent = side_to_move.to_opponent()
+
+    moves = []
+    if target:
+        for move in generate(position, target):
+            square_from = (move >> MOVE_FROM_SHIFT) & MOVE_TO_MASK
+            if square_from == king_square:
+                continue
+            line = pinned.get(square_from)
+            if line is not None and not line & SQUARE_BB[move & MOVE_TO_MASK]:
+                # ピンされている駒は、玉と相手の駒を結ぶ線上にしか動けない
+                continue
+            moves.append(move)
+
+    # 玉を動かす指し手 (相手の利きのないマスにしか動けない)
+    king_captures = []
+    king_non_captures = []
+    own_bb = position.color_bb[side_to_move]
+    move_from = king_square << MOVE_FROM_SHIFT
+    for (square_to,) in MOVE_RAYS[king][king_square]:
+        if own_bb & SQUARE_BB[square_to]:
+            continue
+        if position.is_square_attacked(square_to, opponent, king_square):
+            continue
+        if position.occupied & SQUARE_BB[square_to]:
+            king_captures.append(move_from | square_to)
+        else:
+            king_non_captures.append(move_from | square_to)
+
+    return king_captures + moves + king_non_captures
+
+
+def _check_squares(position, piece, king_square):
+    """piece がそこにあれば king_square の玉に利く (王手になる) マスのビットボードを返す
+
+    空きマスと、玉からたどって最初にある駒のマス (取って王手する) を含む
+    """
+    occupied = position.occupied
+    squares = 0
+    # 玉から外側にたどり、そこから玉に利く駒なら王手になる
+    for ray, adjacent_attackers, long_attackers in SQUARE_RAYS[king_square]:
+        if not adjacent_attackers[piece]:
+            continue
+        for square in ray:
+            squares |= SQUARE_BB[square]
+            if occupied & SQUARE_BB[square] or not long_attackers[piece]:
+                break
+    for square, jump_attackers in SQUARE_JUMPS[king_square]:
+        if jump_attackers[piece]:
+            squares |= SQUARE_BB[square]
+    return squares
+
+
+# 王手になる合法手の生成関数 (詰み探索の攻め方用)
+# do_move をせずに、動かした駒 (成ったときは成った駒) が相手玉に利くマスへの指し手 (直接王手) と、
+# 相手玉と自分の飛び駒の間にある自分の駒をその線の外へ動かす指し手 (開き王手) だけを生成する
+def generate_checks(position):
+    side_to_move = position.side_to_move
+    opponent = side_to_move.to_opponent()
+    king = Piece.BLACK_KING if opponent == Color.BLACK else Piece.WHITE_KING
+    king_bb = position.piece_bb[king]
+    if not king_bb:
+        return []
+    king_square = king_bb.bit_length() - 1
+    board = position.board
+    hand_pieces = position.hand_piece
+
+    # 駒の種類ごとの王手になるマス (盤上の駒は成った駒も調べる)
+    check_squares = [0] * Piece.NUM_PIECES
+    direct_target = 0
     min_piece = Piece.BLACK_PAWN if side_to_move == Color.BLACK else Piece.WHITE_PAWN
-    max_piece = Piece.BLACK_ROOK if side_to_move == Color.BLACK else Piece.WHITE_ROOK
-    for piece_from_val in range(min_piece.value, max_piece.value + 1):
-        if hand_pieces[piece_from_val] == 0:
+    own_king = min_piece + Piece.BLACK_KING - Piece.BLACK_PAWN
+    for piece in range(min_piece, min_piece + PIECE_TYPES):
+        if piece == own_king:
             continue
-        piece_from = Piece(piece_from_val)
+        pieces = []
+        if position.piece_bb[piece]:
+            pieces = [piece, PROMOTED_PIECE[piece]]
+        elif piece < min_piece + DROP_PIECE_TYPES and hand_pieces[piece]:
+            pieces = [piece]
+        for checker in pieces:
+            if not check_squares[checker]:
+                check_squares[checker] = _check_squares(position, checker, king_square)
+                direct_target |= check_squares[checker]
 
-        for file_to in range(Position.BOARD_SIZE):
-            for rank_to in range(Position.BOARD_SIZE):
-                if board[file_to][rank_to] != Piece.NO_PIECE:
-                    continue
+    # 開き王手になる駒 {マス: 相手玉と飛び駒を結ぶ線}
+    discoverers = _blockers(position, king_square, side_to_move, side_to_move)
+    discoverer_bb = 0
+    for square in discoverers:
+        discoverer_bb |= SQUARE_BB[square]
 
-                if not piece_from.can_put_without_promotion(rank_to):
-                    continue
+    candidates = generate(position, direct_target)
+    if discoverer_bb:
+        candidates += generate(position, ALL_BB & ~direct_target, discoverer_bb)
 
-                if (
-                    piece_from == Piece.BLACK_PAWN or piece_from == Piece.WHITE_PAWN
-                ) and is_pawn_exist(board, file_to, piece_from):
-                    # 2歩
-                    continue
+    own_king_square, target, pinned = _legal_context(position)
+    checks = []
+    for move in candidates:
+        square_to = move & MOVE_TO_MASK
+        square_from = (move >> MOVE_FROM_SHIFT) & MOVE_TO_MASK
+        to_bb = SQUARE_BB[square_to]
+        if square_from >= SQUARE_NB:
+            piece = DROP_PIECES[square_from - SQUARE_NB]
+        else:
+            piece = board[SQUARE_FILE[square_from]][SQUARE_RANK[square_from]]
+            if move & MOVE_PROMOTE:
+                piece = PROMOTED_PIECE[piece]
+        if not check_squares[piece] & to_bb:
+            line = discoverers.get(square_from)
+            if line is None or line & to_bb:
+                continue
 
-                yield Move(
-                    file_from=-1,
-                    rank_from=-1,
-                    piece_from=piece_from,
-                    file_to=file_to,
-                    rank_to=rank_to,
-                    piece_to=Piece.NO_PIECE,
-                    drop=True,
-                    promotion=False,
-                    side_to_move=side_to_move,
-                )
+        # 自玉が取られる指し手を除く (generate_legal と同じ判定)
+        if own_king_square is not None:
+            if square_from == own_king_square:
+                if position.is_square_attacked(square_to, opponent, own_king_square):
+                    continue
+            else:
+                if not target & to_bb:
+                    continue
+                line = pinned.get(square_from)
+                if line is not None and not line & to_bb:
+                    continue
+        checks.append(move)
+    return checks
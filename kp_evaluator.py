@@ -0,0 +1,208 @@
+import numpy as np
+
+from evaluator import Evaluator
+from piece_types import Color, Piece
+from bitboard import SQUARE_NB, iter_squares
+from zobrist import MAX_HAND_COUNT
+
+# 玉と駒の位置関係 (KP) と駒の位置 (PSQT) による評価関数
+# 重みは NumPy 配列でファイル (.npz) から読み込む
+#   kp  : [玉のマス][特徴量] 玉を持つ側から見た評価値
+#   psqt: [特徴量] 先手から見た評価値
+# 特徴量は盤上の駒 (玉以外) と持ち駒 (何枚目か) の番号
+#   盤上の駒: 駒 * SQUARE_NB + マス
+#   持ち駒:   FE_HAND + 駒 * (MAX_HAND_COUNT + 1) + 何枚目か
+FE_HAND = Piece.NUM_PIECES * SQUARE_NB
+FE_END = FE_HAND + Piece.NUM_PIECES * (MAX_HAND_COUNT + 1)
+
+FV_SCALE = 16  # 重みの和をこの値で割って評価値 (centipawn) にする
+
+COLOR_OFFSET = Piece.WHITE_PAWN - Piece.BLACK_PAWN  # 先手の駒と後手の駒の番号の差
+
+
+def board_feature(piece: Piece, square: int) -> int:
+    return piece * SQUARE_NB + square
+
+
+def hand_feature(piece: Piece, count: int) -> int:
+    return FE_HAND + piece * (MAX_HAND_COUNT + 1) + count
+
+
+def inverse_square(square: int) -> int:
+    """盤面を 180 度回転させたマス"""
+    return SQUARE_NB - 1 - square
+
+
+def _inverse_piece(piece: int) -> int:
+    if piece == Piece.NO_PIECE:
+        return piece
+    return piece + COLOR_OFFSET if piece < Piece.WHITE_PAWN else piece - COLOR_OFFSET
+
+
+def _build_inverse_features():
+    """後手から見た特徴量 (盤面を 180 度回転させ、先後を入れ替えたもの) の表"""
+    inverse = np.zeros(FE_END, dtype=np.int32)
+    for piece in range(Piece.NUM_PIECES):
+        for square in range(SQUARE_NB):
+            inverse[board_feature(piece, square)] = board_feature(
+                _inverse_piece(piece), inverse_square(square)
+            )
+        for count in range(MAX_HAND_COUNT + 1):
+            inverse[hand_feature(piece, count)] = hand_feature(
+                _inverse_piece(piece), count
+            )
+    return inverse
+
+
+INVERSE_FEATURE = _build_inverse_features()
+
+
+class KPWeights:
+    """KP・PSQT の重み"""
+
+    def __init__(self, kp, psqt):
+        assert kp.shape == (SQUARE_NB, FE_END), "kp の形が正しくありません"
+        assert psqt.shape == (FE_END,), "psqt の形が正しくありません"
+        self.kp = kp.astype(np.int32)
+        self.psqt = psqt.astype(np.int32)
+
+    @staticmethod
+    def zeros():
+        """重みがすべて 0 (駒割りだけの評価と同じになる)"""
+        return KPWeights(
+            np.zeros((SQUARE_NB, FE_END), dtype=np.int32),
+            np.zeros(FE_END, dtype=np.int32),
+        )
+
+    @staticmethod
+    def load(path: str):
+        with np.load(path) as data:
+            return KPWeights(data["kp"], data["psqt"])
+
+    def save(self, path: str) -> None:
+        np.savez_compressed(path, kp=self.kp, psqt=self.psqt)
+
+
+def active_features(position):
+    """局面に現れている特徴量を列挙する"""
+    features = []
+    for piece in range(Piece.BLACK_PAWN, Piece.NUM_PIECES):
+        if piece != Piece.BLACK_KING and piece != Piece.WHITE_KING:
+            for square in iter_squares(position.piece_bb[piece]):
+                features.append(board_feature(piece, square))
+        for count in range(1, position.hand_piece[piece] + 1):
+            features.append(hand_feature(piece, count))
+    return np.array(features, dtype=np.int32)
+
+
+def king_square(position, king: Piece):
+    king_bb = position.piece_bb[king]
+    return king_bb.bit_length() - 1 if king_bb else None
+
+
+class KPAccumulator:
+    """Position の駒の増減に合わせて、重みの和を差分更新する
+
+    Position.accumulator に設定すると、put_piece/remove_piece/put_hand_piece/
+    remove_hand_piece から呼ばれる。玉が動いたときはその玉の側の KP の和だけを計算し直す。
+    """
+
+    def __init__(self, weights, position):
+        self.weights = weights
+        self.position = position
+        self.refresh()
+
+    def refresh(self) -> None:
+        """重みの和を一から計算する"""
+        weights = self.weights
+        position = self.position
+        features = active_features(position)
+        self.psqt = int(weights.psqt[features].sum())
+        # 玉を持つ側から見た KP の和 [手番]
+        self.kp = [0, 0]
+        self.black_king = king_square(position, Piece.BLACK_KING)
+        self.white_king = king_square(position, Piece.WHITE_KING)
+        self._refresh_kp(Color.BLACK, features)
+        self._refresh_kp(Color.WHITE, features)
+
+    def _refresh_kp(self, color, features) -> None:
+        """color の玉から見た KP の和を一から計算する (PSQT と相手の玉の側はそのまま)"""
+        weights = self.weights
+        if color == Color.BLACK:
+            if self.black_king is None:
+                self.kp[Color.BLACK] = 0
+            else:
+                self.kp[Color.BLACK] = int(weights.kp[self.black_king, features].sum())
+        elif self.white_king is None:
+            self.kp[Color.WHITE] = 0
+        else:
+            self.kp[Color.WHITE] = int(
+                weights.kp[
+                    inverse_square(self.white_king), INVERSE_FEATURE[features]
+                ].sum()
+            )
+
+    def _update(self, feature: int, sign: int) -> None:
+        weights = self.weights
+        self.psqt += sign * int(weights.psqt[feature])
+        if self.black_king is not None:
+            self.kp[Color.BLACK] += sign * int(weights.kp[self.black_king, feature])
+        if self.white_king is not None:
+            self.kp[Color.WHITE] += sign * int(
+                weights.kp[inverse_square(self.white_king), INVERSE_FEATURE[feature]]
+            )
+
+    def put_piece(self, piece: Piece, square: int) -> None:
+        if piece == Piece.BLACK_KING:
+            self.black_king = square
+            self._refresh_kp(Color.BLACK, active_features(self.position))
+        elif piece == Piece.WHITE_KING:
+            self.white_king = square
+            self._refresh_kp(Color.WHITE, active_features(self.position))
+        else:
+            self._update(board_feature(piece, square), 1)
+
+    def remove_piece(self, piece: Piece, square: int) -> None:
+        if piece == Piece.BLACK_KING:
+            # 玉を置いたときに計算し直す
+            self.black_king = None
+            self.kp[Color.BLACK] = 0
+        elif piece == Piece.WHITE_KING:
+            self.white_king = None
+            self.kp[Color.WHITE] = 0
+        else:
+            self._update(board_feature(piece, square), -1)
+
+    def put_hand_piece(self, piece: Piece, count: int) -> None:
+        self._update(hand_feature(piece, count), 1)
+
+    def remove_hand_piece(self, piece: Piece, count: int) -> None:
+        self._update(hand_feature(piece, count), -1)
+
+    def value(self) -> int:
+        """先手から見た重みの和"""
+        return self.psqt + self.kp[Color.BLACK] - self.kp[Color.WHITE]
+
+
+class KPEvaluator:
+    """駒割りに KP・PSQT の評価を加えた評価関数
+
+    position.accumulator に KPAccumulator が設定されている必要がある。
+    """
+
+    # True にすると evaluate のたびに差分更新した重みの和を一から計算し直したものと照合する
+    # (デバッグ用)
+    DEBUG_INCREMENTAL = False
+
+    @staticmethod
+    def evaluate(position):
+        accumulator = position.accumulator
+        if KPEvaluator.DEBUG_INCREMENTAL:
+            expected = KPAccumulator(accumulator.weights, position)
+            assert accumulator.value() == expected.value(), "KP の和が一致しません"
+
+        value = Evaluator.evaluate(position)
+        positional = accumulator.value() // FV_SCALE
+        if position.side_to_move == Color.WHITE:
+            positional = -positional
+        return value + positional
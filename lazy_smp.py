@@ -0,0 +1,197 @@
+import multiprocessing
+import queue
+import time
+
+from position import Position
+from evaluator import Evaluator
+from searcher import BestMove, Searcher
+from time_manager import SearchLimits, TimeManager
+from transposition_table import TranspositionTable
+
+RESULT_POLL_INTERVAL = 0.1  # ヘルパーの結果を待つ間に、落ちたヘルパーがないか確かめる間隔 (秒)
+RESULT_TIMEOUT = 5.0  # stop を送ってからヘルパーの結果を待つ最大の時間 (秒)
+JOIN_TIMEOUT = 5.0  # ヘルパーを終了させるときに待つ時間 (秒)。過ぎたら強制終了する
+
+
+class HelperSearcher(Searcher):
+    """ヘルパープロセスの探索部。メインの探索が終わるまで探索を続ける"""
+
+    def __init__(self, tt, thread_id, stop_event, node_counts):
+        super().__init__(tt, thread_id)
+        self.stop_event = stop_event
+        self.node_counts = node_counts
+
+    def check_stop(self) -> None:
+        self.node_counts[self.thread_id] = self.nodes
+        if self.stop_event.is_set():
+            self.stop_requested = True
+            self.stop = True
+
+
+def _helper_main(thread_id, buffer, job_queue, result_queue, stop_event, node_counts):
+    """ヘルパープロセスの本体。局面を受け取るたびに探索し、結果を返す"""
+    tt = TranspositionTable.attach(buffer)
+    searcher = HelperSearcher(tt, thread_id, stop_event, node_counts)
+    position = Position()
+    limits = SearchLimits()
+    limits.infinite = True
+    loaded_eval_file = None
+    while True:
+        job = job_queue.get()
+        if job is None:
+            break
+        sfen, tt.generation, eval_file = job
+        if eval_file != loaded_eval_file:
+            # メインと同じ評価関数を使う
+            if eval_file is None:
+                position.accumulator = None
+                searcher.evaluate = Evaluator.evaluate
+            else:
+                from kp_evaluator import KPAccumulator, KPEvaluator, KPWeights
+
+                position.accumulator = KPAccumulator(KPWeights.load(eval_file), position)
+                searcher.evaluate = KPEvaluator.evaluate
+            loaded_eval_file = eval_file
+        position.set_position(sfen)
+        searcher.stop_requested = False
+        best_move = None
+        for best_move in searcher.iterative_deepening(
+            position, limits, TimeManager(limits, position.side_to_move)
+        ):
+            node_counts[thread_id] = searcher.nodes
+        node_counts[thread_id] = searcher.nodes
+        if best_move is None:
+            result_queue.put((thread_id, None))
+        else:
+            result_queue.put(
+                (
+                    thread_id,
+                    (best_move.move, best_move.value, best_move.pv, best_move.depth),
+                )
+            )
+
+
+class LazySMP:
+    """置換表を共有メモリに置き、複数のプロセスで同じ局面を探索する (Lazy SMP)
+
+    メインの探索は呼び出し元のプロセスで行い、num_threads - 1 個のヘルパープロセスが
+    深さをずらしながら同じ局面を探索して置換表を埋める。
+    """
+
+    def __init__(self):
+        self.num_threads = 1  # USI オプション Threads
+        self.processes = []
+        self.job_queues = []
+        self.buffer = None  # ヘルパーに渡した置換表のバッファ
+        self.context = multiprocessing.get_context("spawn")
+        self.searching = False
+        self.needs_restart = False  # 落ちたか応答しないヘルパーがあったので起動し直す
+        # KP 評価関数の重みファイル。None なら駒割りだけで評価する
+        self.eval_file = None
+
+    def prepare(self, tt) -> None:
+        """num_threads と置換表に合わせてヘルパープロセスを用意する"""
+        if self.num_threads > 1 and not tt.shared:
+            tt.resize(tt.size_mb, shared=True)
+        if (
+            len(self.processes) == self.num_threads - 1
+            and (not self.processes or self.buffer is tt.buffer)
+            and not self.needs_restart
+        ):
+            return
+
+        self.close()
+        self.needs_restart = False
+        self.buffer = tt.buffer
+        self.job_queues = []
+        self.result_queue = self.context.Queue()
+        self.stop_event = self.context.Event()
+        self.node_counts = self.context.RawArray("Q", self.num_threads)
+        for thread_id in range(1, self.num_threads):
+            job_queue = self.context.Queue()
+            process = self.context.Process(
+                target=_helper_main,
+                args=(
+                    thread_id,
+                    tt.buffer,
+                    job_queue,
+                    self.result_queue,
+                    self.stop_event,
+                    self.node_counts,
+                ),
+                daemon=True,
+            )
+            process.start()
+            self.job_queues.append(job_queue)
+            self.processes.append(process)
+
+    def start_search(self, position, generation) -> None:
+        """ヘルパーに探索を始めさせる"""
+        if not self.processes:
+            return
+        self.stop_event.clear()
+        for thread_id in range(self.num_threads):
+            self.node_counts[thread_id] = 0
+        sfen = position.to_sfen()
+        for job_queue in self.job_queues:
+            job_queue.put((sfen, generation, self.eval_file))
+        self.searching = True
+
+    def stop_search(self):
+        """ヘルパーの探索を止め、各ヘルパーが探索し終えた結果 (BestMove) を返す
+
+        bestmove を返せなくならないよう、落ちたヘルパー (EvalFile の読み込みで例外が
+        起きたなど) の結果は待たず、RESULT_TIMEOUT 秒待っても返ってこない結果も使わない。
+        そのときは次の prepare でヘルパーを起動し直す
+        """
+        if not self.searching:
+            return []
+        self.stop_event.set()
+        results = []
+        waiting = set(range(1, len(self.processes) + 1))
+        deadline = time.time() + RESULT_TIMEOUT
+        while waiting and time.time() < deadline:
+            try:
+                thread_id, result = self.result_queue.get(timeout=RESULT_POLL_INTERVAL)
+            except queue.Empty:
+                alive = {
+                    thread_id
+                    for thread_id in waiting
+                    if self.processes[thread_id - 1].is_alive()
+                }
+                if alive != waiting:
+                    self.needs_restart = True
+                waiting = alive
+                continue
+            waiting.discard(thread_id)
+            if result is not None:
+                move, value, pv, depth = result
+                results.append(BestMove(move, value, pv, depth))
+        if waiting:
+            self.needs_restart = True
+        self.searching = False
+        return results
+
+    def nodes(self) -> int:
+        """ヘルパーが探索した局面数の合計"""
+        if not self.processes:
+            return 0
+        return sum(self.node_counts)
+
+    def close(self) -> None:
+        self.stop_search()
+        for job_queue in self.job_queues:
+            job_queue.put(None)
+        for process in self.processes:
+            process.join(JOIN_TIMEOUT)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+        self.processes = []
+        self.job_queues = []
+        self.buffer = None
+
+
+def select_best_move(results):
+    """各プロセスの探索結果から、最も深く読めたもののうち評価値の最も高いものを選ぶ"""
+    return max(results, key=lambda best_move: (best_move.depth, best_move.value))
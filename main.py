@@ -1,93 +1,302 @@
 import sys
 from position import Position
-from generate import generate
-from move import Move
+from generate import generate, generate_legal
+from move import Move, move_from_usi_string, move_to_usi_string
 from evaluator import Evaluator
-import time
 from searcher import Searcher
+from transposition_table import TranspositionTable
+from time_manager import SearchLimits, TimeManager
+from search_thread import SearchThread, send
+import perft
+import bench
+from profiler import Profiler
+from opening_book import OpeningBook
 
+import os
 import random
 import traceback
 
 
+def load_evaluator(eval_type, eval_file, position, search_thread):
+    """USI オプション EvalType・EvalFile に合わせて探索で使う評価関数を切り替える"""
+    searcher = search_thread.searcher
+    if eval_type == "KP":
+        # NumPy が必要なので、使うときだけ読み込む
+        from kp_evaluator import KPAccumulator, KPEvaluator, KPWeights
+
+        if os.path.exists(eval_file):
+            weights = KPWeights.load(eval_file)
+            search_thread.helpers.eval_file = eval_file
+        else:
+            send(f"info string {eval_file} がないので KP の重みを 0 にします")
+            weights = KPWeights.zeros()
+            search_thread.helpers.eval_file = None
+        position.accumulator = KPAccumulator(weights, position)
+        searcher.evaluate = KPEvaluator.evaluate
+    else:
+        position.accumulator = None
+        searcher.evaluate = Evaluator.evaluate
+        search_thread.helpers.eval_file = None
+
+
+class PositionState:
+    """最後に反映した position コマンドの内容"""
+
+    def __init__(self, root_sfen, move_strings, moves, key):
+        self.root_sfen = root_sfen  # 開始局面
+        self.move_strings = move_strings  # 指し手 (USI 形式の文字列)
+        self.moves = moves  # 指し手 (整数で表した指し手)
+        self.key = key  # 反映した後の局面のハッシュキー
+
+
+def apply_position_command(position, line, previous):
+    """position コマンドを局面に反映し、反映した内容 (PositionState) を返す
+
+    前回のコマンドと開始局面が同じなら、共通の手順までは今の局面をそのまま使い、
+    違う部分だけ undo_move/do_move する。対局中は 1 手ずつ伸びていくので、
+    手数が増えても反映にかかる時間は変わらない
+    """
+    tokens = line.split()
+    assert len(tokens) >= 2
+    if tokens[1] == "sfen":
+        root_sfen = " ".join(tokens[2:6])
+        next_index = 6
+    elif tokens[1] == "startpos":
+        root_sfen = Position.start_position_sfen
+        next_index = 2
+    else:
+        print(f"不正なコマンド: {line}")
+        return previous
+    move_strings = [token for token in tokens[next_index:] if token != "moves"]
+
+    common = 0
+    if (
+        previous is not None
+        and previous.root_sfen == root_sfen
+        and previous.key == position.key
+    ):
+        # 前回と共通の手順の長さ
+        max_common = min(len(previous.move_strings), len(move_strings))
+        while (
+            common < max_common
+            and previous.move_strings[common] == move_strings[common]
+        ):
+            common += 1
+        for move in reversed(previous.moves[common:]):
+            position.undo_move(move)
+        moves = previous.moves[:common]
+    else:
+        position.set_position(root_sfen)
+        moves = []
+
+    # 指し手を適用
+    for move_string in move_strings[common:]:
+        move = move_from_usi_string(position, move_string)
+        position.do_move(move)
+        moves.append(move)
+    return PositionState(root_sfen, move_strings, moves, position.key)
+
+
 def main():
     position = Position()
+    # 置換表は対局中の指し手をまたいで使い回す
+    tt = TranspositionTable()
+    searcher = Searcher(tt)
+    # 探索は別スレッドで行い、探索中もこのスレッドでコマンドを読む
+    search_thread = SearchThread(searcher)
+    eval_type = "Material"
+    eval_file = "kp_eval.npz"
+    if Profiler.enabled_by_environment():
+        Profiler.enable(searcher)
+    search_thread.profile_file = Profiler.profile_file_from_environment()
+    # 定跡ファイルは mmap で開くだけなので、起動時に開いておく
+    book = OpeningBook()
+    book_file = "book.bin"
+    book_min_weight = 0
+    book_random = False
+    book.open(book_file)
+    position_state = None  # 最後に反映した position コマンド
     while True:
         try:
-            line = sys.stdin.readline().strip()
+            line = sys.stdin.readline()
+            if not line:
+                # 標準入力が閉じられた
+                search_thread.quit()
+                break
+            line = line.strip()
             if not line:
                 continue
 
             command = line.split()[0]
+            if command not in {"isready", "stop", "ponderhit", "gameover", "quit"}:
+                # 局面や置換表を触るコマンドは探索が終わってから処理する
+                search_thread.wait()
+
             match command:
                 case "usi":
                     print("id name SimpleShogiEngine")
                     print("id author YourName")
+                    print(
+                        "option name USI_Hash type spin "
+                        f"default {TranspositionTable.DEFAULT_SIZE_MB} min 1 max 4096"
+                    )
+                    print(
+                        "option name NetworkDelay type spin "
+                        f"default {TimeManager.NETWORK_DELAY} min 0 max 10000"
+                    )
+                    print("option name USI_Ponder type check default false")
+                    print("option name Threads type spin default 1 min 1 max 256")
+                    print(
+                        "option name EvalType type combo default Material "
+                        "var Material var KP"
+                    )
+                    print(f"option name EvalFile type string default {eval_file}")
+                    print(f"option name BookFile type string default {book_file}")
+                    print(
+                        "option name BookMinWeight type spin "
+                        f"default {book_min_weight} min 0 max 100000000"
+                    )
+                    print(
+                        "option name BookRandom type check "
+                        f"default {str(book_random).lower()}"
+                    )
+                    print(
+                        "option name Profile type check "
+                        f"default {str(Profiler.enabled).lower()}"
+                    )
+                    print(
+                        "option name ProfileFile type string default "
+                        f"{search_thread.profile_file or '<empty>'}"
+                    )
                     print("usiok")
                     sys.stdout.flush()
                 case "isready":
-                    print("readyok")
-                    sys.stdout.flush()
+                    search_thread.prepare()
+                    send("readyok")
+                case "setoption":
+                    # setoption name <id> [value <x>]
+                    tokens = line.split()
+                    name = tokens[2]
+                    value = tokens[4] if len(tokens) >= 5 else None
+                    if name == "USI_Hash":
+                        tt.resize(int(value))
+                    elif name == "NetworkDelay":
+                        TimeManager.NETWORK_DELAY = int(value)
+                    elif name == "Threads":
+                        search_thread.helpers.num_threads = int(value)
+                    elif name in {"EvalType", "EvalFile"}:
+                        if name == "EvalType":
+                            eval_type = value
+                        else:
+                            eval_file = value
+                        load_evaluator(eval_type, eval_file, position, search_thread)
+                        if Profiler.enabled:
+                            # 差し替えた評価関数も計測する
+                            Profiler.disable(searcher)
+                            Profiler.enable(searcher)
+                    elif name == "BookFile":
+                        book_file = value
+                        if value is None:
+                            book.close()
+                        else:
+                            book.open(value)
+                    elif name == "BookMinWeight":
+                        book_min_weight = int(value)
+                    elif name == "BookRandom":
+                        book_random = value == "true"
+                    elif name == "Profile":
+                        if value == "true":
+                            Profiler.enable(searcher)
+                        else:
+                            Profiler.disable(searcher)
+                    elif name == "ProfileFile":
+                        if value in {None, "<empty>"}:
+                            search_thread.profile_file = None
+                        else:
+                            search_thread.profile_file = value
+                case "usinewgame":
+                    tt.clear()
                 case "position":
-                    assert len(line.split()) >= 2
-                    if line.split()[1] == "sfen":
-                        position.set_position(" ".join(line.split()[2:]))
-                        next_index = 6
-                    elif line.split()[1] == "startpos":
-                        position.set_position(Position.start_position_sfen)
-                        next_index = 2
-                    else:
-                        print(f"不正なコマンド: {line}")
-
-                    # 指し手を適用
-                    for move_string in line.split()[next_index:]:
-                        if move_string == "moves":
-                            continue
-                        move = Move.from_usi_string(position, move_string)
-                        position.do_move(move)
+                    position_state = apply_position_command(
+                        position, line, position_state
+                    )
                 case "generatemove":
                     count = 0
                     for move in generate(position):
-                        print(move)
+                        print(Move.from_packed(position, move))
                         sys.stdout.flush()
                         count += 1
                     print(f"合計 {count} 通り")
                 case "okmove":
-                    moves = list(generate(position))
-                    ok_moves = []
-                    for move in moves:
-                        position.do_move(move)
-                        if not position.is_in_checked(
-                            position.side_to_move.to_opponent()
-                        ):
-                            ok_moves.append(move)
-                        position.undo_move(move)
-                    for move in ok_moves:
-                        print(move)
-                case "go":
-                    depth = 3
-                    begin_time = time.time()
-                    nodes = 0
-                    best_move = Searcher.search(position, depth, nodes)
-                    end_time = time.time()
-                    time_diff = end_time - begin_time
-                    best_move_string = best_move.move.to_usi_string()
-                    score_cp = best_move.value
-                    nps = nodes / time_diff
-                    print(
-                        f"info score cp {score_cp} nodes {nodes} nps {nps} time {time_diff} pv {best_move_string}"
+                    for move in generate_legal(position):
+                        print(Move.from_packed(position, move))
+                case "perft":
+                    # perft <depth> [divide] [hash] [processes <n>]
+                    tokens = line.split()
+                    processes = 1
+                    if "processes" in tokens:
+                        processes = int(tokens[tokens.index("processes") + 1])
+                    perft.run(
+                        position,
+                        int(tokens[1]),
+                        show_divide="divide" in tokens,
+                        use_hash="hash" in tokens,
+                        processes=processes,
                     )
-                    if best_move.value < -30000:
-                        print("bestmove resign")
-                    else:
-                        print(f"bestmove {best_move_string}")
                     sys.stdout.flush()
+                case "bench":
+                    # bench [depth <d>] [nodes <n>] [json <path>]
+                    tokens = line.split()
+                    options = dict(zip(tokens[1::2], tokens[2::2]))
+                    bench.run(
+                        int(options["depth"]) if "depth" in options else None,
+                        int(options["nodes"]) if "nodes" in options else None,
+                        options.get("json"),
+                    )
+                    sys.stdout.flush()
+                case "go":
+                    tokens = line.split()
+                    if len(tokens) >= 2 and tokens[1] == "mate":
+                        # go mate <time> | go mate infinite
+                        time_limit = None
+                        if len(tokens) >= 3 and tokens[2] != "infinite":
+                            time_limit = int(tokens[2])
+                        search_thread.start_mate(position, time_limit)
+                    else:
+                        limits = SearchLimits.from_go_command(line)
+                        book_move = None
+                        if not limits.ponder and not limits.infinite:
+                            # 定跡にある局面なら探索せずに指す
+                            book_move = book.select_move(
+                                position, book_min_weight, book_random
+                            )
+                        if book_move is not None:
+                            send("info string book")
+                            send(f"bestmove {move_to_usi_string(book_move)}")
+                        else:
+                            search_thread.start(position, limits)
+                case "stop":
+                    search_thread.stop()
+                case "ponderhit":
+                    search_thread.ponderhit()
+                case "gameover":
+                    search_thread.stop()
                 case "eval":
-                    print(Evaluator.evaluate(position))
+                    print(searcher.evaluate(position))
+                case "stats":
+                    # stats [reset]
+                    if not Profiler.enabled:
+                        print("info string Profile が無効です")
+                    for stats_line in Profiler.summary():
+                        print(f"info string {stats_line}")
+                    if line.split()[-1] == "reset":
+                        Profiler.reset()
+                    sys.stdout.flush()
                 case "check":
                     print(position.is_in_checked())
                     sys.stdout.flush()
                 case "quit":
+                    search_thread.quit()
                     break
                 case "d":
                     print(position)
@@ -0,0 +1,490 @@
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import queue
+import shlex
+import subprocess
+import sys
+import threading
+import time
+
+from position import Position
+from piece_types import Color
+from generate import generate_legal
+from move import move_from_usi_string
+
+# 対局の結果 (先に指定したエンジンから見た結果)
+RESULT_WIN = "win"
+RESULT_LOSS = "loss"
+RESULT_DRAW = "draw"
+
+DEFAULT_MAX_PLY = 256  # この手数に達したら引き分け
+REPETITION_COUNT = 4  # 同じ局面がこの回数現れたら千日手 (連続王手でなければ引き分け)
+TIME_MARGIN = 1000  # 思考時間の超過を負けにするまでの猶予 (ミリ秒)
+ENGINE_TIMEOUT = 60.0  # usiok・readyok を待つ時間 (秒)
+MATE_SCORE = 100000  # score mate を評価値に直すときの値
+
+
+class UsiEngine:
+    """USI エンジンを子プロセスとして起動し、コマンドを送って応答を読む"""
+
+    def __init__(self, command, options=None, name=None):
+        args = shlex.split(command)
+        # エンジンのファイルがあるディレクトリで起動する (定跡ファイルなどの相対パスのため)
+        script = next((arg for arg in args if arg.endswith(".py")), None)
+        cwd = os.path.dirname(os.path.abspath(script)) if script else None
+        self.name = name or command
+        self.process = subprocess.Popen(
+            args,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+            bufsize=1,
+            cwd=cwd,
+        )
+        # 応答を待つときにタイムアウトできるよう、別スレッドで標準出力を読む
+        self.lines = queue.Queue()
+        self.reader = threading.Thread(target=self._read, daemon=True)
+        self.reader.start()
+
+        self.send("usi")
+        self.wait_for("usiok", ENGINE_TIMEOUT)
+        for name, value in (options or {}).items():
+            self.send(f"setoption name {name} value {value}")
+        self.send("isready")
+        self.wait_for("readyok", ENGINE_TIMEOUT)
+
+    def _read(self) -> None:
+        for line in self.process.stdout:
+            self.lines.put(line.strip())
+        self.lines.put(None)
+
+    def send(self, line: str) -> None:
+        self.process.stdin.write(line + "\n")
+        self.process.stdin.flush()
+
+    def read_line(self, timeout):
+        """1 行読む。タイムアウトかエンジンが終了したら None を返す"""
+        try:
+            return self.lines.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def wait_for(self, token, timeout):
+        """token で始まる行が来るまで読み捨て、その行を返す"""
+        deadline = time.time() + timeout
+        while True:
+            line = self.read_line(max(0.0, deadline - time.time()))
+            if line is None:
+                raise RuntimeError(f"{self.name}: {token} が返ってきません")
+            if line.split(" ", 1)[0] == token:
+                return line
+
+    def go(self, position_command, go_command, timeout):
+        """局面を送って探索させ、(指し手の文字列, 最後の評価値, 経過ミリ秒) を返す
+
+        制限時間内に bestmove が返ってこなければ指し手は None
+        """
+        self.send(position_command)
+        self.send(go_command)
+        start_time = time.time()
+        score = None
+        while True:
+            remaining = timeout - (time.time() - start_time)
+            line = self.read_line(max(0.0, remaining))
+            if line is None:
+                return None, score, int((time.time() - start_time) * 1000)
+            tokens = line.split()
+            if tokens[0] == "bestmove":
+                return tokens[1], score, int((time.time() - start_time) * 1000)
+            if tokens[0] == "info" and "score" in tokens:
+                index = tokens.index("score")
+                if index + 2 < len(tokens):
+                    if tokens[index + 1] == "mate":
+                        # 手数は省略 ("mate +" "mate -") されることがあるので符号だけ見る
+                        # 詰まされている側は "mate -0" のように符号で分かる
+                        negative = tokens[index + 2].startswith("-")
+                        score = -MATE_SCORE if negative else MATE_SCORE
+                    elif tokens[index + 1] == "cp":
+                        score = int(tokens[index + 2])
+
+    def quit(self) -> None:
+        try:
+            self.send("quit")
+            self.process.wait(timeout=5)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+
+
+class TimeControl:
+    """持ち時間 (ミリ秒)。time と inc は手番ごとに、byoyomi は 1 手ごとに使う (inc があれば使わない)"""
+
+    def __init__(self, time=0, inc=0, byoyomi=1000):
+        self.time = time
+        self.inc = inc
+        self.byoyomi = byoyomi
+
+
+class Adjudication:
+    """評価値による投了・引き分けの判定の設定"""
+
+    def __init__(
+        self,
+        resign_score=None,
+        resign_moves=4,
+        draw_score=None,
+        draw_moves=8,
+        draw_min_ply=80,
+    ):
+        self.resign_score = resign_score  # 両者がこれ以上の差を認めたら勝ち負けを付ける
+        self.resign_moves = resign_moves  # 何手続いたら判定するか (両者の手の合計)
+        self.draw_score = draw_score  # 両者の評価値の絶対値がこれ以下なら引き分けにする
+        self.draw_moves = draw_moves
+        self.draw_min_ply = draw_min_ply  # 引き分けの判定を始める手数
+
+
+def play_game(game_id, sfen, engines, time_control, adjudication, max_ply):
+    """1 局指し、結果の dict を返す
+
+    engines は [(コマンド, オプション), (コマンド, オプション)]。game_id が偶数なら
+    engines[0] が、奇数なら engines[1] が開始局面の手番側を持つ
+    """
+    first = game_id % 2  # 開始局面の手番側を持つエンジン
+    players = [None, None]
+    try:
+        for i in (first, 1 - first):
+            command, options = engines[i]
+            players[i] = UsiEngine(command, options)
+        for player in players:
+            player.send("usinewgame")
+
+        position = Position()
+        position.set_position(sfen)
+        start_color = position.side_to_move
+        remaining = [time_control.time, time_control.time]
+        move_strings = []
+        gave_check = []  # 1 手ごとに、指した手が王手だったか
+        scores = []  # 1 手ごとの、開始局面の手番側から見た評価値
+        result, reason = RESULT_DRAW, "max_ply"
+        # 手番側のエンジンが勝ったときの、engines[0] から見た結果
+        for ply in range(max_ply):
+            side = position.side_to_move
+            mover = first if side == start_color else 1 - first
+            if not generate_legal(position):
+                result, reason = _result_for(mover, False), "checkmate"
+                break
+
+            position_command = f"position sfen {sfen}"
+            if move_strings:
+                position_command += " moves " + " ".join(move_strings)
+            black_time, white_time = remaining[Color.BLACK], remaining[Color.WHITE]
+            go_command = f"go btime {black_time} wtime {white_time} "
+            limit = remaining[side] + time_control.inc
+            if time_control.inc:
+                go_command += f"binc {time_control.inc} winc {time_control.inc}"
+            else:
+                # 秒読みはエンジンに送ったときだけ思考時間に含める
+                go_command += f"byoyomi {time_control.byoyomi}"
+                limit += time_control.byoyomi
+            move_string, score, elapsed = players[mover].go(
+                position_command, go_command, (limit + TIME_MARGIN) / 1000
+            )
+            if move_string is None or elapsed > limit + TIME_MARGIN:
+                result, reason = _result_for(mover, False), "time"
+                break
+            remaining[side] = max(0, remaining[side] - elapsed) + time_control.inc
+            if move_string == "resign":
+                result, reason = _result_for(mover, False), "resign"
+                break
+            if move_string == "win":
+                result, reason = _result_for(mover, True), "declaration"
+                break
+            move = move_from_usi_string(position, move_string)
+            if move not in generate_legal(position):
+                result, reason = _result_for(mover, False), "illegal"
+                break
+            position.do_move(move)
+            move_strings.append(move_string)
+            gave_check.append(position.is_in_checked())
+
+            if position.key_history.count(position.key) >= REPETITION_COUNT - 1:
+                result, reason = _repetition_result(position, gave_check, first)
+                break
+
+            if score is not None:
+                scores.append(score if side == start_color else -score)
+            adjudicated = _adjudicate(scores, ply + 1, adjudication)
+            if adjudicated is not None:
+                # 開始局面の手番側から見た結果を engines[0] から見た結果に直す
+                if adjudicated == RESULT_DRAW:
+                    result = RESULT_DRAW
+                else:
+                    result = _result_for(first, adjudicated == RESULT_WIN)
+                reason = "adjudication"
+                break
+
+        for i, player in enumerate(players):
+            if result == RESULT_DRAW:
+                player.send("gameover draw")
+            else:
+                won = (result == RESULT_WIN) == (i == 0)
+                player.send(f"gameover {'win' if won else 'lose'}")
+        return {
+            "game": game_id,
+            "sfen": sfen,
+            "result": result,
+            "reason": reason,
+            "plies": len(move_strings),
+            "moves": " ".join(move_strings),
+        }
+    finally:
+        for player in players:
+            if player is not None:
+                player.quit()
+
+
+def _repetition_result(position, gave_check, first):
+    """千日手の (engines[0] から見た結果, 理由)
+
+    最初に同じ局面が現れてからの手が全て王手だった側は、連続王手の千日手で負け
+    """
+    start = position.key_history.index(position.key)
+    for parity in (0, 1):
+        if all(gave_check[start + parity :: 2]):
+            # 開始局面から偶数手目は、開始局面の手番側 (engines[first]) の手
+            player = first if (start + parity) % 2 == 0 else 1 - first
+            return _result_for(player, False), "perpetual_check"
+    return RESULT_DRAW, "repetition"
+
+
+def _result_for(player, won):
+    """engines[player] が勝った (won) か負けたときの、engines[0] から見た結果"""
+    return RESULT_WIN if won == (player == 0) else RESULT_LOSS
+
+
+def _adjudicate(scores, ply, adjudication):
+    """評価値の推移から、開始局面の手番側から見た結果を判定する。判定しないなら None"""
+    if adjudication.resign_score is not None and len(scores) >= adjudication.resign_moves:
+        recent = scores[-adjudication.resign_moves :]
+        if all(score >= adjudication.resign_score for score in recent):
+            return RESULT_WIN
+        if all(score <= -adjudication.resign_score for score in recent):
+            return RESULT_LOSS
+    if (
+        adjudication.draw_score is not None
+        and ply >= adjudication.draw_min_ply
+        and len(scores) >= adjudication.draw_moves
+    ):
+        recent = scores[-adjudication.draw_moves :]
+        if all(abs(score) <= adjudication.draw_score for score in recent):
+            return RESULT_DRAW
+    return None
+
+
+def _play_game_job(job):
+    """プロセスプールで 1 局指す。エンジンが落ちたなどの例外は結果に含めて返す"""
+    try:
+        return play_game(*job)
+    except Exception as e:
+        return {"game": job[0], "sfen": job[1], "error": str(e)}
+
+
+def elo_estimate(wins, draws, losses):
+    """勝敗から Elo レーティングの差とその 95% 信頼区間の幅を推定する"""
+    games = wins + draws + losses
+    if games == 0:
+        return 0.0, 0.0
+    score = (wins + draws / 2) / games
+    variance = (
+        wins * (1 - score) ** 2 + draws * (0.5 - score) ** 2 + losses * score**2
+    ) / games
+    score = min(max(score, 1e-6), 1 - 1e-6)
+    elo = -400 * math.log10(1 / score - 1)
+    # 勝率の標準誤差を Elo の傾きで換算する
+    slope = 400 / (math.log(10) * score * (1 - score))
+    error = 1.96 * math.sqrt(variance / games) * slope
+    return elo, error
+
+
+def sprt_llr(wins, draws, losses, elo0, elo1):
+    """SPRT の対数尤度比 (勝率の正規近似)"""
+    games = wins + draws + losses
+    if games == 0:
+        return 0.0
+    score = (wins + draws / 2) / games
+    variance = (
+        wins * (1 - score) ** 2 + draws * (0.5 - score) ** 2 + losses * score**2
+    ) / games
+    if variance <= 0:
+        return 0.0
+    score0 = 1 / (1 + 10 ** (-elo0 / 400))
+    score1 = 1 / (1 + 10 ** (-elo1 / 400))
+    return games * (score1 - score0) * (2 * score - score0 - score1) / (2 * variance)
+
+
+def sprt_bounds(alpha, beta):
+    """SPRT を打ち切る対数尤度比の (下限, 上限)"""
+    return math.log(beta / (1 - alpha)), math.log((1 - beta) / alpha)
+
+
+def load_results(path):
+    """結果ファイル (1 行 1 局の JSON) から、終わった対局の結果を読む"""
+    results = {}
+    if path is not None and os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                record = json.loads(line)
+                if "result" in record:
+                    results[record["game"]] = record
+    return results
+
+
+def run_match(
+    engines,
+    openings,
+    num_games,
+    time_control,
+    adjudication,
+    results_path=None,
+    processes=1,
+    max_ply=DEFAULT_MAX_PLY,
+    sprt=None,
+    output=print,
+):
+    """対局を並列に指し、勝敗・Elo・SPRT を表示しながら結果ファイルに追記する
+
+    開始局面は openings から順に使い、同じ開始局面で先後を入れ替えて 2 局ずつ指す。
+    結果ファイルに記録済みの対局は指し直さないので、中断しても続きから再開できる。
+    sprt は (elo0, elo1, alpha, beta) で、対数尤度比が境界を超えたら打ち切る
+    """
+    results = load_results(results_path)
+    counts = {RESULT_WIN: 0, RESULT_DRAW: 0, RESULT_LOSS: 0}
+    for record in results.values():
+        counts[record["result"]] += 1
+    jobs = [
+        (
+            game_id,
+            openings[(game_id // 2) % len(openings)],
+            engines,
+            time_control,
+            adjudication,
+            max_ply,
+        )
+        for game_id in range(num_games)
+        if game_id not in results
+    ]
+    if results:
+        output(f"info string resume from {len(results)} games")
+
+    results_file = open(results_path, "a", encoding="utf-8") if results_path else None
+    pool = multiprocessing.get_context("spawn").Pool(processes)
+    try:
+        for record in pool.imap_unordered(_play_game_job, jobs):
+            if "error" in record:
+                output(f"info string game {record['game']} error: {record['error']}")
+                continue
+            counts[record["result"]] += 1
+            if results_file is not None:
+                results_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+                results_file.flush()
+
+            wins, draws, losses = counts[RESULT_WIN], counts[RESULT_DRAW], counts[RESULT_LOSS]
+            elo, error = elo_estimate(wins, draws, losses)
+            line = (
+                f"games {wins + draws + losses} +{wins} ={draws} -{losses} "
+                f"elo {elo:.1f} +/- {error:.1f}"
+            )
+            if sprt is not None:
+                elo0, elo1, alpha, beta = sprt
+                llr = sprt_llr(wins, draws, losses, elo0, elo1)
+                lower, upper = sprt_bounds(alpha, beta)
+                line += f" llr {llr:.2f} ({lower:.2f}, {upper:.2f})"
+                if llr >= upper or llr <= lower:
+                    output(line)
+                    output(f"info string SPRT {'H1' if llr >= upper else 'H0'} accepted")
+                    break
+            output(line)
+    finally:
+        pool.terminate()
+        pool.join()
+        if results_file is not None:
+            results_file.close()
+    return counts
+
+
+def _parse_options(options):
+    """["Name=Value", ...] を {Name: Value} にする"""
+    return dict(option.split("=", 1) for option in options or [])
+
+
+def main():
+    """2 つのエンジンを対局させて強さを比べる
+
+    python match.py --engine1 "python main.py" --engine2 "python ../old/main.py" \\
+        --option1 EvalType=KP --openings openings.sfen --games 200 --byoyomi 1000 \\
+        --results results.jsonl --sprt 0 5
+    """
+    parser = argparse.ArgumentParser(description="エンジン同士の対局")
+    parser.add_argument("--engine1", default=f"{sys.executable} main.py")
+    parser.add_argument("--engine2", default=f"{sys.executable} main.py")
+    parser.add_argument("--option1", action="append", help="engine1 の USI オプション Name=Value")
+    parser.add_argument("--option2", action="append", help="engine2 の USI オプション Name=Value")
+    parser.add_argument("--openings", default=None, help="開始局面の SFEN ファイル (1 行 1 局面)")
+    parser.add_argument("--games", type=int, default=100)
+    parser.add_argument("--time", type=int, default=0, help="持ち時間 (ミリ秒)")
+    parser.add_argument("--inc", type=int, default=0, help="1 手ごとの加算 (ミリ秒)")
+    parser.add_argument("--byoyomi", type=int, default=1000, help="秒読み (ミリ秒、--inc を指定したときは使わない)")
+    parser.add_argument("--max-ply", type=int, default=DEFAULT_MAX_PLY)
+    parser.add_argument("--resign-score", type=int, default=None)
+    parser.add_argument("--resign-moves", type=int, default=4)
+    parser.add_argument("--draw-score", type=int, default=None)
+    parser.add_argument("--draw-moves", type=int, default=8)
+    parser.add_argument("--draw-min-ply", type=int, default=80)
+    parser.add_argument("--results", default=None, help="結果を追記する JSON Lines ファイル")
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1)
+    parser.add_argument(
+        "--sprt", type=float, nargs=2, metavar=("ELO0", "ELO1"), default=None
+    )
+    parser.add_argument("--alpha", type=float, default=0.05)
+    parser.add_argument("--beta", type=float, default=0.05)
+    args = parser.parse_args()
+
+    openings = [Position.start_position_sfen]
+    if args.openings is not None:
+        with open(args.openings, encoding="utf-8") as f:
+            openings = [line.strip() for line in f if line.strip()]
+    engines = [
+        (args.engine1, _parse_options(args.option1)),
+        (args.engine2, _parse_options(args.option2)),
+    ]
+    sprt = None
+    if args.sprt is not None:
+        sprt = (args.sprt[0], args.sprt[1], args.alpha, args.beta)
+    run_match(
+        engines,
+        openings,
+        args.games,
+        TimeControl(args.time, args.inc, args.byoyomi),
+        Adjudication(
+            args.resign_score,
+            args.resign_moves,
+            args.draw_score,
+            args.draw_moves,
+            args.draw_min_ply,
+        ),
+        args.results,
+        args.processes,
+        args.max_ply,
+        sprt,
+    )
+    sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
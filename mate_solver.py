@@ -0,0 +1,342 @@
+import argparse
+import sys
+import time
+
+from position import Position
+from piece_types import Color, Piece
+from generate import generate_checks, generate_legal
+from move import move_from, move_to_usi_string
+from bitboard import SQUARE_NB
+
+PN_INFINITE = 1 << 30  # 証明数・反証数の無限大
+MATE_MAX_PLY = 255  # これより深い手順は詰まないものとして扱う
+CHECK_INTERVAL = 16  # 何局面ごとに時間と局面数の制限を確認するか
+MAX_TABLE_KEYS = 1 << 20  # 証明表に覚えておく盤面の数の上限 (超えたら空にする)
+
+# 打ち歩詰めを判定するための、歩を打つ指し手の移動元
+PAWN_DROP_FROM = {
+    (SQUARE_NB + Piece.BLACK_PAWN),
+    (SQUARE_NB + Piece.WHITE_PAWN),
+}
+# 持ち駒の種類 (歩から飛車まで) の、先手と後手の Piece の差
+HAND_COLOR_OFFSET = Piece.WHITE_PAWN - Piece.BLACK_PAWN
+
+
+class MateSolver:
+    """df-pn (depth-first proof-number search) による詰み探索
+
+    攻め方 (探索開始時の手番) は王手になる指し手だけを、玉方は全ての王手回避を調べる。
+    証明数・反証数は攻め方から見た値で、盤面のキーごとに攻め方の持ち駒と一緒に覚えておく。
+    盤面が同じなら、詰んだ局面より攻め方の持ち駒が多い局面も詰み、
+    詰まなかった局面より持ち駒が少ない局面も詰まない (持ち駒の優越関係) として使い回す。
+    千日手で詰まなかった局面は、そこに至る手順によって結果が変わる (GHI 問題) ので、
+    千日手になった祖先の局面のキーを一緒に覚えておき、それらが全て今の手順上にあるときだけ使う
+    """
+
+    def __init__(self):
+        # {盤面のキー (手番を含む): [[攻め方の持ち駒, 証明数, 反証数, 依存する祖先, 詰みまでの手数], ...]}
+        # 依存する祖先は、不詰みが千日手によるときの祖先の局面のキーの frozenset (なければ None)
+        # 詰みまでの手数は、詰んだ局面で証明したときの手順の長さ (詰んでいなければ 0)
+        self.table = {}
+        self.attacker = Color.BLACK
+        self.nodes = 0
+        self.node_limit = None
+        self.time_limit = None  # ミリ秒
+        self.start_time = 0.0
+        self.stop = False  # True になったら探索を打ち切る
+        self.stop_requested = False  # stop コマンドを受け取った (別スレッドから書き換える)
+
+    def solve(self, position, time_limit=None, node_limit=None):
+        """手番側が玉方を詰ませられるか調べる
+
+        詰みなら詰み手順 (整数で表した指し手のリスト) を、詰まないか制限に達したら None を返す。
+        制限に達したかどうかは stop で分かる
+        """
+        self.table = {}
+        self.attacker = position.side_to_move
+        self.nodes = 0
+        self.node_limit = node_limit
+        self.time_limit = time_limit
+        self.start_time = time.time()
+        self.stop = False
+        self._mid(position, PN_INFINITE, PN_INFINITE, 0, set())
+        if self.stop:
+            return None
+        pn, _, _ = self._lookup(position.board_key, self._attacker_hand(position), set())
+        if pn != 0:
+            return None
+        pv = self._proof_pv(position)
+        if pv is None:
+            # 証明表が途中で空になったなどで詰み手順をたどれなかったので、制限に達したものとして扱う
+            self.stop = True
+        return pv
+
+    def elapsed(self) -> int:
+        """探索開始からの経過時間 (ミリ秒)"""
+        return int((time.time() - self.start_time) * 1000)
+
+    def _check_stop(self) -> None:
+        if self.stop_requested:
+            self.stop = True
+        elif self.node_limit is not None and self.nodes >= self.node_limit:
+            self.stop = True
+        elif self.time_limit is not None and self.elapsed() >= self.time_limit:
+            self.stop = True
+
+    def _attacker_hand(self, position):
+        """攻め方の持ち駒 (歩から飛車までの枚数のタプル)
+
+        盤面が同じなら、玉方の持ち駒は攻め方の持ち駒から決まる
+        """
+        offset = 0 if self.attacker == Color.BLACK else HAND_COLOR_OFFSET
+        start = Piece.BLACK_PAWN + offset
+        return tuple(position.hand_piece[start : start + Piece.BLACK_KING - 1])
+
+    def _lookup(self, key, hand, path):
+        """証明表から (証明数, 反証数, 不詰みが依存する祖先) を引く
+
+        見つからなければ (1, 1, None) を返す。千日手による不詰みは、依存する祖先が
+        全て path (今の手順上の局面のキー) にあるときだけ使う
+        """
+        entries = self.table.get(key)
+        if entries is None:
+            return 1, 1, None
+        result = (1, 1, None)
+        for entry_hand, pn, dn, ancestors, _ in entries:
+            if pn == 0:
+                # 詰んだときより攻め方の持ち駒が多ければ詰み
+                if all(a >= b for a, b in zip(hand, entry_hand)):
+                    return 0, PN_INFINITE, None
+            elif dn == 0:
+                # 詰まなかったときより攻め方の持ち駒が少なければ不詰み
+                if (ancestors is None or ancestors <= path) and all(
+                    a <= b for a, b in zip(hand, entry_hand)
+                ):
+                    return PN_INFINITE, 0, ancestors
+            elif entry_hand == hand:
+                result = (pn, dn, None)
+        return result
+
+    def _mate_length(self, key, hand):
+        """証明表から、詰みまでの手数を引く (使える詰みの証明のうち最も短いもの)
+
+        詰みが証明されていなければ None を返す
+        """
+        length = None
+        for entry_hand, pn, _, _, entry_length in self.table.get(key, ()):
+            if (
+                pn == 0
+                and (length is None or entry_length < length)
+                and all(a >= b for a, b in zip(hand, entry_hand))
+            ):
+                length = entry_length
+        return length
+
+    def _store(self, key, hand, pn, dn, ancestors=None, length=0) -> None:
+        entries = self.table.get(key)
+        if entries is None:
+            if len(self.table) >= MAX_TABLE_KEYS:
+                self.table.clear()
+            entries = self.table[key] = []
+        for entry in entries:
+            if entry[0] == hand:
+                entry[1] = pn
+                entry[2] = dn
+                entry[3] = ancestors
+                entry[4] = length
+                return
+        entries.append([hand, pn, dn, ancestors, length])
+
+    def _is_pawn_drop_mate(self, position, move) -> bool:
+        """do_move した直後に呼び、その指し手が打ち歩詰めかどうかを返す"""
+        return move_from(move) in PAWN_DROP_FROM and not generate_legal(position)
+
+    def _mid(self, position, phi_threshold, delta_threshold, ply, path) -> None:
+        """局面を展開し、φ (攻め方の手番なら証明数、玉方の手番なら反証数) が phi_threshold 以上か
+        δ (その逆) が delta_threshold 以上になるまで子局面を探索する"""
+        self.nodes += 1
+        if self.nodes % CHECK_INTERVAL == 0:
+            self._check_stop()
+
+        key = position.board_key
+        hand = self._attacker_hand(position)
+        or_node = position.side_to_move == self.attacker
+        moves = generate_checks(position) if or_node else generate_legal(position)
+
+        # 子局面の (指し手, 盤面のキー, 攻め方の持ち駒, キー, 手数制限で評価できないか)
+        children = []
+        for move in moves:
+            position.do_move(move)
+            if or_node and self._is_pawn_drop_mate(position, move):
+                # 打ち歩詰めは反則
+                position.undo_move(move)
+                continue
+            children.append(
+                (
+                    move,
+                    position.board_key,
+                    self._attacker_hand(position),
+                    position.key,
+                    ply + 1 >= MATE_MAX_PLY,
+                )
+            )
+            position.undo_move(move)
+
+        if not children:
+            # 王手がなければ不詰み、王手回避がなければ詰み
+            if or_node:
+                self._store(key, hand, PN_INFINITE, 0)
+            else:
+                self._store(key, hand, 0, PN_INFINITE)
+            return
+
+        path.add(position.key)
+        while True:
+            # 子局面の φ・δ から、この局面の φ (子の δ の最小値) と δ (子の φ の和) を求める
+            phi = PN_INFINITE
+            delta = 0
+            best_child = None
+            best_child_phi = 0
+            second_delta = PN_INFINITE
+            # この局面が詰まないときに、それが依存する祖先の局面のキー
+            # 攻め方の手番なら不詰みの子全ての和、玉方の手番なら不詰みの子の 1 つ
+            ancestors = set() if or_node else None
+            for child in children:
+                if child[3] in path:
+                    # 千日手は攻め方の負け
+                    pn, dn, child_ancestors = PN_INFINITE, 0, frozenset((child[3],))
+                elif child[4]:
+                    # 手数制限は攻め方の負け
+                    pn, dn, child_ancestors = PN_INFINITE, 0, None
+                else:
+                    pn, dn, child_ancestors = self._lookup(child[1], child[2], path)
+                if dn == 0:
+                    child_ancestors = child_ancestors or frozenset()
+                    if or_node:
+                        ancestors |= child_ancestors
+                    elif ancestors is None or len(child_ancestors) < len(ancestors):
+                        ancestors = child_ancestors
+                child_phi, child_delta = (dn, pn) if or_node else (pn, dn)
+                delta = min(PN_INFINITE, delta + child_phi)
+                if child_delta < phi:
+                    second_delta = phi
+                    phi = child_delta
+                    best_child = child
+                    best_child_phi = child_phi
+                elif child_delta < second_delta:
+                    second_delta = child_delta
+
+            if phi >= phi_threshold or delta >= delta_threshold or self.stop:
+                break
+
+            # 最も有望な子局面を、兄弟の値を超えない範囲の閾値で探索する
+            if delta_threshold >= PN_INFINITE:
+                child_phi_threshold = PN_INFINITE
+            else:
+                child_phi_threshold = delta_threshold - delta + best_child_phi
+            child_delta_threshold = min(phi_threshold, second_delta + 1)
+            move = best_child[0]
+            position.do_move(move)
+            self._mid(position, child_phi_threshold, child_delta_threshold, ply + 1, path)
+            position.undo_move(move)
+        path.discard(position.key)
+
+        if not self.stop:
+            # 自分自身に戻る千日手は、どの手順でこの局面に来ても起きる
+            ancestors = frozenset((ancestors or set()) - {position.key}) or None
+            pn = phi if or_node else delta
+            if pn == 0:
+                # 詰みまでの手数は、攻め方は最も短く詰む子、玉方は最も長く逃れる子から決まる
+                lengths = [
+                    self._mate_length(child[1], child[2])
+                    for child in children
+                    if child[3] not in path and not child[4]
+                ]
+                lengths = [length for length in lengths if length is not None]
+                length = 1 + (min(lengths) if or_node else max(lengths))
+                self._store(key, hand, 0, PN_INFINITE, None, length)
+            elif or_node:
+                if phi < PN_INFINITE:
+                    ancestors = None
+                self._store(key, hand, phi, delta, ancestors)
+            else:
+                if delta < PN_INFINITE:
+                    ancestors = None
+                self._store(key, hand, delta, phi, ancestors)
+
+    def _proof_pv(self, position):
+        """証明表をたどって詰み手順を求める
+
+        攻め方は詰みまでの手数が最も短い子、玉方は最も長い子を選ぶ
+        (証明したときの手数なので、最短手順とは限らない)。
+        たどった手順が詰みで終わらなければ None を返す
+        """
+        pv = []
+        visited = set()
+        while len(pv) < MATE_MAX_PLY:
+            visited.add(position.key)
+            or_node = position.side_to_move == self.attacker
+            moves = generate_checks(position) if or_node else generate_legal(position)
+            best_move = None
+            best_length = None
+            for move in moves:
+                position.do_move(move)
+                if position.key not in visited and not (
+                    or_node and self._is_pawn_drop_mate(position, move)
+                ):
+                    length = self._mate_length(
+                        position.board_key, self._attacker_hand(position)
+                    )
+                    if length is not None and (
+                        best_length is None
+                        or (length < best_length if or_node else length > best_length)
+                    ):
+                        best_move = move
+                        best_length = length
+                position.undo_move(move)
+            if best_move is None:
+                break
+            position.do_move(best_move)
+            pv.append(best_move)
+
+        # 玉方の手番で王手回避がなければ詰み
+        is_mate = position.side_to_move != self.attacker and not generate_legal(position)
+        for move in reversed(pv):
+            position.undo_move(move)
+        return pv if is_mate else None
+
+
+def main():
+    """1 行 1 局面の SFEN ファイルの詰将棋を解き、1 行ずつ結果を出力する
+
+    python mate_solver.py problems.sfen --time 10000
+    """
+    parser = argparse.ArgumentParser(description="df-pn による詰将棋の解図")
+    parser.add_argument("path")
+    parser.add_argument("--time", type=int, default=None, help="1 問あたりの制限時間 (ミリ秒)")
+    parser.add_argument("--nodes", type=int, default=None, help="1 問あたりの局面数の上限")
+    args = parser.parse_args()
+
+    solver = MateSolver()
+    position = Position()
+    with open(args.path, encoding="utf-8") as f:
+        for line in f:
+            sfen = line.strip()
+            if not sfen:
+                continue
+            position.set_position(sfen)
+            pv = solver.solve(position, args.time, args.nodes)
+            if pv is not None:
+                result = " ".join(move_to_usi_string(move) for move in pv)
+            elif solver.stop:
+                result = "timeout"
+            else:
+                result = "nomate"
+            sys.stdout.write(
+                f"{result}\t{len(pv) if pv else 0}\t{solver.nodes}\t{solver.elapsed()}\n"
+            )
+            sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
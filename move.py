@@ -1,4 +1,5 @@
-from piece_types import Color, Piece, CHAR_TO_PIECE
+from piece_types import Color, Piece, CHAR_TO_PIECE, PIECE_TO_CHAR
+from bitboard import SQUARE_FILE, SQUARE_NB, SQUARE_RANK, to_square
 
 
 class Move:
@@ -132,8 +133,162 @@ class Move:
         move.side_to_move = position.side_to_move
         return move
 
+    def to_packed(self):
+        """整数で表した指し手に変換する"""
+        if self == Move.Resign:
+            return MOVE_RESIGN
+        elif self == Move.Win:
+            return MOVE_WIN
+        elif self == Move.NoneMove:
+            return MOVE_NONE
+
+        square_to = to_square(self.file_to, self.rank_to)
+        if self.drop:
+            return make_drop(self.piece_from, square_to)
+        return make_move(
+            to_square(self.file_from, self.rank_from), square_to, self.promotion
+        )
+
+    @staticmethod
+    def from_packed(position, move):
+        """整数で表した指し手を Move に変換する (指し手を指す前の局面を渡すこと)"""
+        if move == MOVE_RESIGN:
+            return Move.Resign
+        elif move == MOVE_WIN:
+            return Move.Win
+        elif move == MOVE_NONE:
+            return Move.NoneMove
+
+        square_to = move_to(move)
+        file_to = SQUARE_FILE[square_to]
+        rank_to = SQUARE_RANK[square_to]
+        if is_drop(move):
+            return Move(
+                file_from=-1,
+                rank_from=-1,
+                piece_from=move_dropped_piece(move),
+                file_to=file_to,
+                rank_to=rank_to,
+                piece_to=Piece.NO_PIECE,
+                drop=True,
+                promotion=False,
+                side_to_move=position.side_to_move,
+            )
+
+        square_from = move_from(move)
+        file_from = SQUARE_FILE[square_from]
+        rank_from = SQUARE_RANK[square_from]
+        return Move(
+            file_from=file_from,
+            rank_from=rank_from,
+            piece_from=position.board[file_from][rank_from],
+            file_to=file_to,
+            rank_to=rank_to,
+            piece_to=position.board[file_to][rank_to],
+            drop=False,
+            promotion=is_promotion(move),
+            side_to_move=position.side_to_move,
+        )
+
 
 # 静的なインスタンス定義
 Move.Resign = Move(file_from=2, file_to=2)
 Move.Win = Move(file_from=3, file_to=3)
 Move.NoneMove = Move(file_from=4, file_to=4)
+
+
+# 整数で表した指し手
+# 探索や指し手生成ではオブジェクトを作らずにこちらを使い、
+# Move や USI 文字列への変換はプロトコルの入出力でのみ行う
+#   bit  0- 6: 移動先のマス
+#   bit  7-13: 移動元のマス (駒打ちの場合は SQUARE_NB + 打つ駒)
+#   bit 14   : 成り
+# 動かした駒・取った駒は局面から求める
+MOVE_TO_MASK = 0x7F
+MOVE_FROM_SHIFT = 7
+MOVE_PROMOTE = 1 << 14
+
+# 特殊な指し手 (移動元と移動先が同じマスなので通常の指し手と重ならない)
+MOVE_NONE = 0
+MOVE_RESIGN = (2 << MOVE_FROM_SHIFT) + 2
+MOVE_WIN = (3 << MOVE_FROM_SHIFT) + 3
+
+# 駒打ちの指し手から打つ駒を引く表
+DROP_PIECES = list(Piece)
+
+
+def make_move(square_from: int, square_to: int, promotion: bool = False) -> int:
+    move = (square_from << MOVE_FROM_SHIFT) | square_to
+    if promotion:
+        move |= MOVE_PROMOTE
+    return move
+
+
+def make_drop(piece: Piece, square_to: int) -> int:
+    return ((SQUARE_NB + piece) << MOVE_FROM_SHIFT) | square_to
+
+
+def move_to(move: int) -> int:
+    return move & MOVE_TO_MASK
+
+
+def move_from(move: int) -> int:
+    return (move >> MOVE_FROM_SHIFT) & MOVE_TO_MASK
+
+
+def is_drop(move: int) -> bool:
+    return move_from(move) >= SQUARE_NB
+
+
+def is_promotion(move: int) -> bool:
+    return move & MOVE_PROMOTE != 0
+
+
+def move_dropped_piece(move: int) -> Piece:
+    return DROP_PIECES[move_from(move) - SQUARE_NB]
+
+
+def move_to_usi_string(move: int) -> str:
+    if move == MOVE_RESIGN:
+        return "resign"
+    elif move == MOVE_WIN:
+        return "win"
+    elif move == MOVE_NONE:
+        return "none"
+
+    square_to = move_to(move)
+    if is_drop(move):
+        usi_string = PIECE_TO_CHAR[move_dropped_piece(move)].upper() + "*"
+    else:
+        square_from = move_from(move)
+        usi_string = chr(SQUARE_FILE[square_from] + ord("1"))
+        usi_string += chr(SQUARE_RANK[square_from] + ord("a"))
+
+    usi_string += chr(SQUARE_FILE[square_to] + ord("1"))
+    usi_string += chr(SQUARE_RANK[square_to] + ord("a"))
+
+    if is_promotion(move):
+        usi_string += "+"
+
+    return usi_string
+
+
+def move_from_usi_string(position, move_string: str) -> int:
+    if move_string == "resign":
+        return MOVE_RESIGN
+    elif move_string == "win":
+        return MOVE_WIN
+    elif move_string == "none":
+        return MOVE_NONE
+
+    square_to = to_square(ord(move_string[2]) - ord("1"), ord(move_string[3]) - ord("a"))
+    if move_string[1] == "*":
+        # 駒打ちの指し手
+        piece = CHAR_TO_PIECE[move_string[0]]
+        if position.side_to_move == Color.WHITE:
+            piece = piece.as_opponent_hand_piece()
+        return make_drop(piece, square_to)
+
+    # 駒を移動する指し手
+    square_from = to_square(ord(move_string[0]) - ord("1"), ord(move_string[1]) - ord("a"))
+    return make_move(square_from, square_to, len(move_string) == 5)
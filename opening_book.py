@@ -0,0 +1,119 @@
+import mmap
+import os
+import random
+import struct
+
+from generate import generate_legal
+
+# 定跡ファイル
+# 1 レコード 16 バイト (リトルエンディアン) を局面のハッシュキーの昇順に並べたもの
+#   局面のハッシュキー (Position.key) 8 バイト
+#   指し手 (整数で表した指し手) 2 バイト
+#   重み (出現回数など) 4 バイト
+#   評価値 2 バイト (符号付き)
+# 同じ局面のレコードは重みの大きい順に並べる
+BOOK_RECORD = struct.Struct("<QHIh")
+BOOK_KEY = struct.Struct("<Q")
+
+
+class BookEntry:
+    """定跡の 1 手"""
+
+    def __init__(self, move, weight, score):
+        self.move = move
+        self.weight = weight
+        self.score = score
+
+
+class OpeningBook:
+    """mmap で開いた定跡ファイルを二分探索で引く
+
+    ファイルはメモリに読み込まずに OS のページキャッシュを通して参照するので、
+    開くのに時間がかからず、複数のエンジンのプロセスで同じメモリを共有できる
+    """
+
+    def __init__(self):
+        self.path = None
+        self.file = None
+        self.buffer = None
+        self.num_records = 0
+
+    def open(self, path) -> bool:
+        """定跡ファイルを開く。ファイルがなければ False を返す"""
+        self.close()
+        if not os.path.exists(path):
+            return False
+        self.path = path
+        self.file = open(path, "rb")
+        size = os.path.getsize(path)
+        self.num_records = size // BOOK_RECORD.size
+        if self.num_records > 0:
+            # 長さ 0 のファイルは mmap できない
+            self.buffer = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        return True
+
+    def close(self) -> None:
+        if self.buffer is not None:
+            self.buffer.close()
+        if self.file is not None:
+            self.file.close()
+        self.path = None
+        self.file = None
+        self.buffer = None
+        self.num_records = 0
+
+    def _lower_bound(self, key) -> int:
+        """key 以上のハッシュキーを持つ最初のレコードの番号"""
+        low = 0
+        high = self.num_records
+        while low < high:
+            middle = (low + high) // 2
+            (middle_key,) = BOOK_KEY.unpack_from(self.buffer, middle * BOOK_RECORD.size)
+            if middle_key < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def probe(self, key) -> list[BookEntry]:
+        """局面のハッシュキーに一致する定跡の指し手を重みの大きい順に返す"""
+        if self.num_records == 0:
+            return []
+        entries = []
+        index = self._lower_bound(key)
+        while index < self.num_records:
+            record_key, move, weight, score = BOOK_RECORD.unpack_from(
+                self.buffer, index * BOOK_RECORD.size
+            )
+            if record_key != key:
+                break
+            entries.append(BookEntry(move, weight, score))
+            index += 1
+        return entries
+
+    def select_move(self, position, min_weight=0, random_select=False, rng=random):
+        """定跡から指し手を選ぶ。定跡にない局面なら None を返す
+
+        random_select が True なら重みに比例した確率で、False なら重みの最も大きい指し手を選ぶ。
+        ハッシュキーの衝突に備えて、合法手でない指し手は使わない
+        """
+        entries = [entry for entry in self.probe(position.key) if entry.weight >= min_weight]
+        if not entries:
+            return None
+        legal_moves = set(generate_legal(position))
+        entries = [entry for entry in entries if entry.move in legal_moves]
+        if not entries:
+            return None
+        if random_select:
+            total = sum(entry.weight for entry in entries)
+            if total > 0:
+                return rng.choices(entries, [entry.weight for entry in entries])[0].move
+        return max(entries, key=lambda entry: (entry.weight, entry.score)).move
+
+    @staticmethod
+    def write(path, records) -> None:
+        """[(ハッシュキー, 指し手, 重み, 評価値), ...] を並べ替えて定跡ファイルに書き出す"""
+        records = sorted(records, key=lambda record: (record[0], -record[2]))
+        with open(path, "wb") as f:
+            for record in records:
+                f.write(BOOK_RECORD.pack(*record))
@@ -0,0 +1,119 @@
+import argparse
+import multiprocessing
+import sys
+import time
+
+from position import Position
+from generate import generate_legal
+from move import move_to_usi_string
+
+# 部分木のノード数をキャッシュする局面数の上限 (超えたら空にする)
+HASH_ENTRIES = 1 << 20
+
+
+def perft(position, depth, cache=None) -> int:
+    """depth 手先までの合法手の末端局面数を数える
+
+    最後の 1 手は do_move せずに合法手の数をそのまま足す (bulk counting)。
+    cache に dict を渡すと、(局面のキー, 残り深さ) ごとに部分木のノード数を覚えておき、
+    合流した局面を数え直さない
+    """
+    if depth <= 0:
+        return 1
+    moves = generate_legal(position)
+    if depth == 1:
+        return len(moves)
+
+    if cache is not None:
+        cache_key = (position.key, depth)
+        nodes = cache.get(cache_key)
+        if nodes is not None:
+            return nodes
+
+    nodes = 0
+    for move in moves:
+        position.do_move(move)
+        nodes += perft(position, depth - 1, cache)
+        position.undo_move(move)
+
+    if cache is not None:
+        if len(cache) >= HASH_ENTRIES:
+            cache.clear()
+        cache[cache_key] = nodes
+    return nodes
+
+
+def _perft_root_move(job):
+    """プロセスプールで 1 つのルートの指し手の部分木を数える"""
+    sfen, move, depth, use_hash = job
+    position = Position()
+    position.set_position(sfen)
+    position.do_move(move)
+    return perft(position, depth - 1, {} if use_hash else None)
+
+
+def divide(position, depth, use_hash=False, processes=1):
+    """ルートの指し手ごとの末端局面数を [(指し手, ノード数), ...] で返す
+
+    processes が 2 以上のときは、ルートの指し手をプロセスプールに振り分けて数える
+    """
+    moves = generate_legal(position)
+    if depth <= 1:
+        return [(move, 1) for move in moves]
+
+    if processes > 1:
+        sfen = position.to_sfen()
+        jobs = [(sfen, move, depth, use_hash) for move in moves]
+        with multiprocessing.get_context("spawn").Pool(processes) as pool:
+            counts = pool.map(_perft_root_move, jobs)
+        return list(zip(moves, counts))
+
+    cache = {} if use_hash else None
+    result = []
+    for move in moves:
+        position.do_move(move)
+        result.append((move, perft(position, depth - 1, cache)))
+        position.undo_move(move)
+    return result
+
+
+def run(position, depth, show_divide=False, use_hash=False, processes=1, output=print):
+    """perft を実行し、(ルートの指し手ごとの内訳と) ノード数・NPS を出力する"""
+    start_time = time.perf_counter()
+    if show_divide or processes > 1:
+        result = divide(position, depth, use_hash, processes)
+        nodes = sum(count for _, count in result)
+    else:
+        result = []
+        nodes = perft(position, depth, {} if use_hash else None)
+    elapsed = time.perf_counter() - start_time
+
+    if show_divide:
+        for move, count in result:
+            output(f"{move_to_usi_string(move)}: {count}")
+    nps = int(nodes / elapsed) if elapsed > 0 else 0
+    output(f"nodes {nodes} time {int(elapsed * 1000)} nps {nps}")
+    return nodes
+
+
+def main():
+    """コマンドラインから perft を実行する
+
+    python perft.py 4 --sfen "<sfen>" --divide --hash --processes 4
+    """
+    parser = argparse.ArgumentParser(description="合法手生成の perft")
+    parser.add_argument("depth", type=int)
+    parser.add_argument("--sfen", default=Position.start_position_sfen)
+    parser.add_argument("--divide", action="store_true", help="ルートの指し手ごとに出力")
+    parser.add_argument("--hash", action="store_true", help="部分木のノード数をキャッシュ")
+    parser.add_argument("--processes", type=int, default=1)
+    args = parser.parse_args()
+
+    position = Position()
+    position.set_position(args.sfen)
+    run(position, args.depth, args.divide, args.hash, args.processes)
+    sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
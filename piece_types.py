@@ -1,7 +1,7 @@
-from enum import Enum, unique
+from enum import IntEnum, unique
 
 
-class Color(Enum):
+class Color(IntEnum):
     BLACK = 0
     WHITE = 1
 
@@ -10,7 +10,7 @@ class Color(Enum):
 
 
 @unique
-class Piece(Enum):
+class Piece(IntEnum):
     NO_PIECE = 0
     BLACK_PAWN = 1
     BLACK_LANCE = 2
@@ -57,6 +57,10 @@ class Piece(Enum):
         assert self != Piece.NO_PIECE
         return NON_PROMOTED_TO_PROMOTED.get(self, self)
 
+    def as_unpromoted(self):
+        assert self != Piece.NO_PIECE
+        return PROMOTED_TO_NON_PROMOTED.get(self, self)
+
     def to_char(self):
         assert self != Piece.NO_PIECE
         return PIECE_TO_CHAR.get(self, None)
@@ -185,6 +189,10 @@ NON_PROMOTED_TO_PROMOTED = {
     Piece.WHITE_ROOK: Piece.WHITE_DRAGON,
 }
 
+PROMOTED_TO_NON_PROMOTED = {
+    promoted: piece for piece, promoted in NON_PROMOTED_TO_PROMOTED.items()
+}
+
 PIECE_TO_OPPONENT_PIECE = {
     Piece.BLACK_PAWN: Piece.WHITE_PAWN,
     Piece.BLACK_LANCE: Piece.WHITE_LANCE,
@@ -1,5 +1,126 @@
 from piece_types import Color, Piece
 from piece_types import CHAR_TO_PIECE
+from bitboard import BOARD_SIZE, FILE_BB, SQUARE_BB, SQUARE_FILE, SQUARE_NB
+from bitboard import SQUARE_RANK
+from bitboard import iter_squares, to_square
+from move import DROP_PIECES, MOVE_FROM_SHIFT, MOVE_PROMOTE, MOVE_TO_MASK
+from zobrist import ZOBRIST_BOARD, ZOBRIST_HAND, ZOBRIST_SIDE
+from evaluator import Evaluator
+
+PIECE_VALUES = Evaluator.PIECE_VALUES
+
+# 駒ごとの利きの方向 [駒] {(筋の差, 段の差): 飛び利きかどうか}
+ATTACK_DIRECTIONS = [None] + [
+    {
+        (move_direction.direction.delta_file, move_direction.direction.delta_rank): (
+            move_direction.is_long
+        )
+        for move_direction in Piece(piece).move_directions()
+    }
+    for piece in range(Piece.BLACK_PAWN, Piece.NUM_PIECES)
+]
+
+# 周囲 8 方向 (飛び利きの方向)
+RAY_DELTAS = [
+    (delta_file, delta_rank)
+    for delta_file in (-1, 0, 1)
+    for delta_rank in (-1, 0, 1)
+    if delta_file != 0 or delta_rank != 0
+]
+
+# 8 方向以外の利き (桂馬)
+JUMP_DELTAS = sorted(
+    {
+        delta
+        for directions in ATTACK_DIRECTIONS[1:]
+        for delta in directions
+        if delta not in RAY_DELTAS
+    }
+)
+
+
+def _ray_squares(square, delta_file, delta_rank, is_long):
+    """square から (delta_file, delta_rank) 方向にたどったマスのリスト (盤外は含まない)"""
+    squares = []
+    file = SQUARE_FILE[square] + delta_file
+    rank = SQUARE_RANK[square] + delta_rank
+    while 0 <= file < BOARD_SIZE and 0 <= rank < BOARD_SIZE:
+        squares.append(to_square(file, rank))
+        if not is_long:
+            break
+        file += delta_file
+        rank += delta_rank
+    return tuple(squares)
+
+
+# 駒の動き [駒][移動元のマス] [移動先のマスのタプル, ...]
+# Piece.move_directions() の方向の順に、その方向に近い順に並べたもの
+# (飛び利きでない方向は 1 マスだけ。盤外に出る方向は含まない)
+MOVE_RAYS = [None] + [
+    [
+        [
+            ray
+            for move_direction in Piece(piece).move_directions()
+            if (
+                ray := _ray_squares(
+                    square,
+                    move_direction.direction.delta_file,
+                    move_direction.direction.delta_rank,
+                    move_direction.is_long,
+                )
+            )
+        ]
+        for square in range(SQUARE_NB)
+    ]
+    for piece in range(Piece.BLACK_PAWN, Piece.NUM_PIECES)
+]
+
+
+def _attackers_table(delta_file, delta_rank, long_only):
+    """(delta_file, delta_rank) 方向の隣のマスから、逆向きに利きがある駒かどうかの [駒] のリスト"""
+    table = [False] * Piece.NUM_PIECES
+    for piece in range(Piece.BLACK_PAWN, Piece.NUM_PIECES):
+        is_long = ATTACK_DIRECTIONS[piece].get((-delta_file, -delta_rank))
+        table[piece] = is_long is not None and (is_long or not long_only)
+    return table
+
+
+# マスから外側に向かう 8 方向 [マス] [(マスのタプル, 隣から利く駒, 離れていても利く駒), ...]
+# 駒のリストは [駒] で引く bool のリスト
+SQUARE_RAYS = [
+    [
+        (
+            ray,
+            _attackers_table(delta_file, delta_rank, False),
+            _attackers_table(delta_file, delta_rank, True),
+        )
+        for delta_file, delta_rank in RAY_DELTAS
+        if (ray := _ray_squares(square, delta_file, delta_rank, True))
+    ]
+    for square in range(SQUARE_NB)
+]
+
+# マスに桂馬の動きで利く位置 [マス] [(マス, 利く駒), ...]
+SQUARE_JUMPS = [
+    [
+        (
+            ray[0],
+            _attackers_table(delta_file, delta_rank, False),
+        )
+        for delta_file, delta_rank in JUMP_DELTAS
+        if (ray := _ray_squares(square, delta_file, delta_rank, False))
+    ]
+    for square in range(SQUARE_NB)
+]
+
+# 縦・横・斜めに並んだ 2 マスの間のマスのビットボード [マス][マス]
+BETWEEN_BB = [[0] * SQUARE_NB for _ in range(SQUARE_NB)]
+for _square in range(SQUARE_NB):
+    for _ray, _, _ in SQUARE_RAYS[_square]:
+        _between = 0
+        for _square_to in _ray:
+            BETWEEN_BB[_square][_square_to] = _between
+            _between |= SQUARE_BB[_square_to]
 
 
 class Position:
@@ -7,6 +128,9 @@ class Position:
         "lnsgkgsnl/1r5b1/ppppppppp/9/9/9/PPPPPPPPP/1B5R1/LNSGKGSNL b - 1"
     )
     BOARD_SIZE = 9  # 盤面の一辺のマス数
+    # True にすると do_move/undo_move のたびに差分計算したハッシュキーを
+    # 一から計算し直したものと照合する (デバッグ用)
+    DEBUG_HASH = False
 
     def __init__(self):
         self.side_to_move = Color.BLACK  # 初期手番は先手
@@ -15,6 +139,22 @@ class Position:
             [Piece.NO_PIECE] * self.BOARD_SIZE for _ in range(self.BOARD_SIZE)
         ]
         self.hand_piece = [0] * Piece.NUM_PIECES.value  # 持ち駒の初期化
+        # ビットボード (盤面 board と常に同期させる)
+        self.piece_bb = [0] * Piece.NUM_PIECES.value  # 駒種ごと
+        self.color_bb = [0, 0]  # 手番ごと
+        self.occupied = 0  # 駒のあるマス
+        # 成っていない歩がある筋 (bit n が n 筋目 (0 始まり)) の手番ごとのマスク。二歩の判定に使う
+        self.pawn_files = [0, 0]
+        # ハッシュキー (盤面と手番、持ち駒) を do_move/undo_move で差分更新する
+        self.board_key = 0
+        self.hand_key = 0
+        # 先手から見た駒割り (盤上の駒と持ち駒の Evaluator.PIECE_VALUES の合計) を差分更新する
+        self.material = 0
+        # 駒の増減を通知する先 (KPAccumulator など)。None なら通知しない
+        self.accumulator = None
+        self.captured_pieces = []  # 1手ごとに取った駒 (undo_move 用)
+        # 1手ごとの指す前の局面のハッシュキー (千日手の判定などで使う)
+        self.key_history = []
         self.play = 1  # 初期手数
         self.black_king_file = 0
         self.black_king_rank = 0
@@ -59,6 +199,15 @@ class Position:
             [Piece.NO_PIECE] * self.BOARD_SIZE for _ in range(self.BOARD_SIZE)
         ]
         self.hand_piece = [0] * Piece.NUM_PIECES.value  # 持ち駒の初期化
+        self.piece_bb = [0] * Piece.NUM_PIECES.value
+        self.color_bb = [0, 0]
+        self.occupied = 0
+        self.pawn_files = [0, 0]
+        self.board_key = 0
+        self.hand_key = 0
+        self.material = 0
+        self.captured_pieces = []
+        self.key_history = []
         self.play = 1
 
         file = self.BOARD_SIZE - 1
@@ -79,16 +228,14 @@ class Position:
                 promotion = True
             elif c.isdigit():
                 empty_sequnce = int(c)
-                for _ in range(empty_sequnce):
-                    self.board[file][rank] = Piece.NO_PIECE
-                    file -= 1
+                file -= empty_sequnce
             else:
                 piece = CHAR_TO_PIECE.get(c, None)
                 assert piece is not None
                 if promotion:
                     piece = piece.as_promoted()
                     promotion = False
-                self.board[file][rank] = piece
+                self.put_piece(file, rank, piece)
 
                 if piece == Piece.BLACK_KING:
                     self.black_king_file = file
@@ -129,119 +276,271 @@ class Position:
         index += 1
         self.play = int(sfen[index:])
 
+        self.board_key, self.hand_key = self.compute_keys()
+        self.material = Evaluator.compute_material(self)
+        if self.accumulator is not None:
+            self.accumulator.refresh()
+
+    def to_sfen(self) -> str:
+        """局面を SFEN 文字列に変換する"""
+        rows = []
+        for rank in range(self.BOARD_SIZE):
+            row = ""
+            empty_sequence = 0
+            for file in range(self.BOARD_SIZE - 1, -1, -1):
+                piece = self.board[file][rank]
+                if piece == Piece.NO_PIECE:
+                    empty_sequence += 1
+                    continue
+                if empty_sequence > 0:
+                    row += str(empty_sequence)
+                    empty_sequence = 0
+                if piece != piece.as_unpromoted():
+                    row += "+"
+                row += piece.as_unpromoted().to_char()
+            if empty_sequence > 0:
+                row += str(empty_sequence)
+            rows.append(row)
+
+        hand = ""
+        for piece_char in "RBGSNLPrbgsnlp":
+            count = self.hand_piece[CHAR_TO_PIECE[piece_char]]
+            if count > 1:
+                hand += str(count)
+            if count > 0:
+                hand += piece_char
+
+        side = "b" if self.side_to_move == Color.BLACK else "w"
+        return f"{'/'.join(rows)} {side} {hand or '-'} {self.play}"
+
+    @property
+    def key(self) -> int:
+        """局面のハッシュキー (盤面、持ち駒、手番)"""
+        return self.board_key ^ self.hand_key
+
+    def compute_keys(self):
+        """盤面のキー (手番を含む) と持ち駒のキーを一から計算する"""
+        board_key = ZOBRIST_SIDE if self.side_to_move == Color.WHITE else 0
+        for piece in range(Piece.BLACK_PAWN, Piece.NUM_PIECES):
+            for square in iter_squares(self.piece_bb[piece]):
+                board_key ^= ZOBRIST_BOARD[piece][square]
+
+        hand_key = 0
+        for piece, count in enumerate(self.hand_piece):
+            for n in range(1, count + 1):
+                hand_key ^= ZOBRIST_HAND[piece][n]
+        return board_key, hand_key
+
+    def check_keys(self) -> None:
+        """差分計算したハッシュキーが一から計算したものと一致するか確かめる"""
+        board_key, hand_key = self.compute_keys()
+        assert self.board_key == board_key, "board_key が一致しません"
+        assert self.hand_key == hand_key, "hand_key が一致しません"
+
     def put_piece(self, file: int, rank: int, piece: Piece) -> None:
         assert self.board[file][rank] == Piece.NO_PIECE  # すでに駒がある場合はエラー
         self.board[file][rank] = piece
+        square = to_square(file, rank)
+        bb = SQUARE_BB[square]
+        self.piece_bb[piece] |= bb
+        self.board_key ^= ZOBRIST_BOARD[piece][square]
+        self.material += PIECE_VALUES[piece]
+        self.color_bb[Color.WHITE if piece >= Piece.WHITE_PAWN else Color.BLACK] |= bb
+        self.occupied |= bb
+        if piece == Piece.BLACK_PAWN:
+            self.pawn_files[Color.BLACK] |= 1 << file
+        elif piece == Piece.WHITE_PAWN:
+            self.pawn_files[Color.WHITE] |= 1 << file
+        if self.accumulator is not None:
+            self.accumulator.put_piece(piece, square)
 
     def remove_piece(self, file: int, rank: int) -> None:
-        assert self.board[file][rank] != Piece.NO_PIECE  # 駒がない場合はエラー
+        piece = self.board[file][rank]
+        assert piece != Piece.NO_PIECE  # 駒がない場合はエラー
         self.board[file][rank] = Piece.NO_PIECE
+        square = to_square(file, rank)
+        bb = SQUARE_BB[square]
+        self.piece_bb[piece] ^= bb
+        self.board_key ^= ZOBRIST_BOARD[piece][square]
+        self.material -= PIECE_VALUES[piece]
+        self.color_bb[Color.WHITE if piece >= Piece.WHITE_PAWN else Color.BLACK] ^= bb
+        self.occupied ^= bb
+        if piece == Piece.BLACK_PAWN or piece == Piece.WHITE_PAWN:
+            color = Color.BLACK if piece == Piece.BLACK_PAWN else Color.WHITE
+            if not self.piece_bb[piece] & FILE_BB[file]:
+                # 同じ筋にもう歩がない (二歩の局面が与えられることもあるので確かめる)
+                self.pawn_files[color] &= ~(1 << file)
+        if self.accumulator is not None:
+            self.accumulator.remove_piece(piece, square)
 
     def put_hand_piece(self, piece: Piece) -> None:
         # 持ち駒に駒を加える
-        self.hand_piece[piece.value] += 1
+        self.hand_piece[piece] += 1
+        self.hand_key ^= ZOBRIST_HAND[piece][self.hand_piece[piece]]
+        self.material += PIECE_VALUES[piece]
+        if self.accumulator is not None:
+            self.accumulator.put_hand_piece(piece, self.hand_piece[piece])
 
     def remove_hand_piece(self, piece: Piece) -> None:
         # 持ち駒から駒を取り除く
-        assert self.hand_piece[piece.value] > 0
-        self.hand_piece[piece.value] -= 1
-
-    def do_move(self, move):
-        """与えられた指し手に従い、局面を1手進める"""
-        assert self.side_to_move == move.side_to_move
-        assert (
-            move.drop or self.board[move.file_from][move.rank_from] == move.piece_from
-        )
-        assert move.drop or self.board[move.file_to][move.rank_to] == move.piece_to
+        assert self.hand_piece[piece] > 0
+        if self.accumulator is not None:
+            self.accumulator.remove_hand_piece(piece, self.hand_piece[piece])
+        self.hand_key ^= ZOBRIST_HAND[piece][self.hand_piece[piece]]
+        self.hand_piece[piece] -= 1
+        self.material -= PIECE_VALUES[piece]
+
+    def do_move(self, move: int) -> None:
+        """与えられた指し手 (整数で表した指し手) に従い、局面を1手進める"""
+        square_to = move & MOVE_TO_MASK
+        square_from = (move >> MOVE_FROM_SHIFT) & MOVE_TO_MASK
+        file_to = SQUARE_FILE[square_to]
+        rank_to = SQUARE_RANK[square_to]
+        self.key_history.append(self.board_key ^ self.hand_key)
 
         # 相手の駒を取る
-        if move.piece_to != Piece.NO_PIECE:
-            self.remove_piece(move.file_to, move.rank_to)
-            self.put_hand_piece(move.piece_to.as_opponent_hand_piece())
+        piece_to = self.board[file_to][rank_to]
+        if piece_to != Piece.NO_PIECE:
+            assert piece_to.to_color() != self.side_to_move
+            self.remove_piece(file_to, rank_to)
+            self.put_hand_piece(piece_to.as_opponent_hand_piece())
 
-        if move.drop:
+        if square_from >= SQUARE_NB:
             # 持ち駒を打つ
-            self.remove_hand_piece(move.piece_from)
+            piece_from = DROP_PIECES[square_from - SQUARE_NB]
+            self.remove_hand_piece(piece_from)
         else:
             # 盤面の駒を移動
-            self.remove_piece(move.file_from, move.rank_from)
-
-        # 駒を配置（成り判定）
-        self.put_piece(
-            move.file_to,
-            move.rank_to,
-            move.piece_from.as_promoted() if move.promotion else move.piece_from,
-        )
-
-        if move.piece_from == Piece.BLACK_KING:
-            self.black_king_file = move.file_to
-            self.black_king_rank = move.rank_to
-        if move.piece_from == Piece.WHITE_KING:
-            self.white_king_file = move.file_to
-            self.white_king_rank = move.rank_to
-
+            file_from = SQUARE_FILE[square_from]
+            rank_from = SQUARE_RANK[square_from]
+            piece_from = self.board[file_from][rank_from]
+            self.remove_piece(file_from, rank_from)
+            if piece_from == Piece.BLACK_KING:
+                self.black_king_file = file_to
+                self.black_king_rank = rank_to
+            elif piece_from == Piece.WHITE_KING:
+                self.white_king_file = file_to
+                self.white_king_rank = rank_to
+            if move & MOVE_PROMOTE:
+                piece_from = piece_from.as_promoted()
+        assert piece_from.to_color() == self.side_to_move
+
+        # 駒を配置
+        self.put_piece(file_to, rank_to, piece_from)
+
+        # 取った駒は undo_move で戻すために積んでおく
+        self.captured_pieces.append(piece_to)
         self.side_to_move = self.side_to_move.to_opponent()
+        self.board_key ^= ZOBRIST_SIDE
         self.play += 1
         self.last_move = move
 
-    def undo_move(self, move) -> None:
-        """与えられた指し手に従い、局面を1手戻す"""
-        assert self.side_to_move != move.side_to_move
+        if Position.DEBUG_HASH:
+            self.check_keys()
+
+    def undo_move(self, move: int) -> None:
+        """与えられた指し手 (整数で表した指し手) に従い、局面を1手戻す"""
+        square_to = move & MOVE_TO_MASK
+        square_from = (move >> MOVE_FROM_SHIFT) & MOVE_TO_MASK
+        file_to = SQUARE_FILE[square_to]
+        rank_to = SQUARE_RANK[square_to]
 
         self.play -= 1
         self.side_to_move = self.side_to_move.to_opponent()
+        self.board_key ^= ZOBRIST_SIDE
+        piece_to = self.captured_pieces.pop()
+        self.key_history.pop()
 
-        if move.piece_from == Piece.BLACK_KING:
-            self.black_king_file = move.file_from
-            self.black_king_rank = move.rank_from
-        if move.piece_from == Piece.WHITE_KING:
-            self.white_king_file = move.file_from
-            self.white_king_rank = move.rank_from
+        piece_from = self.board[file_to][rank_to]
+        self.remove_piece(file_to, rank_to)
 
-        self.remove_piece(move.file_to, move.rank_to)
-
-        if move.drop:
+        if square_from >= SQUARE_NB:
             # 持ち駒を打った場合
-            self.put_hand_piece(move.piece_from)
+            self.put_hand_piece(piece_from)
         else:
             # 盤面の駒を戻す
-            self.put_piece(move.file_from, move.rank_from, move.piece_from)
+            file_from = SQUARE_FILE[square_from]
+            rank_from = SQUARE_RANK[square_from]
+            if move & MOVE_PROMOTE:
+                piece_from = piece_from.as_unpromoted()
+            self.put_piece(file_from, rank_from, piece_from)
+            if piece_from == Piece.BLACK_KING:
+                self.black_king_file = file_from
+                self.black_king_rank = rank_from
+            elif piece_from == Piece.WHITE_KING:
+                self.white_king_file = file_from
+                self.white_king_rank = rank_from
 
         # 取った駒を戻す
-        if move.piece_to != Piece.NO_PIECE:
-            self.remove_hand_piece(move.piece_to.as_opponent_hand_piece())
-            self.put_piece(move.file_to, move.rank_to, move.piece_to)
-
-    def is_in_checked(self, color) -> bool:
-        """指定した手番の王が王手されているかどうかを返す"""
-        king = Piece.BLACK_KING if color == Color.BLACK else Piece.WHITE_KING
-        for file_from in range(self.BOARD_SIZE):
-            for rank_from in range(self.BOARD_SIZE):
-                piece_from = self.board[file_from][rank_from]
-                if piece_from == Piece.NO_PIECE:
-                    # 駒がない場合はスキップ
-                    continue
-                if piece_from.to_color() == color:
-                    # 自分の駒の場合はスキップ
+        if piece_to != Piece.NO_PIECE:
+            self.remove_hand_piece(piece_to.as_opponent_hand_piece())
+            self.put_piece(file_to, rank_to, piece_to)
+
+        if Position.DEBUG_HASH:
+            self.check_keys()
+
+    def is_in_checked(self, color=None) -> bool:
+        """指定した手番 (省略時は手番側) の王が王手されているかどうかを返す"""
+        if color is None:
+            color = self.side_to_move
+        king_bb = self.piece_bb[
+            Piece.BLACK_KING if color == Color.BLACK else Piece.WHITE_KING
+        ]
+        if not king_bb:
+            return False
+        # 王のマスから外側に向かって、王に利いている相手の駒を探す
+        return self.is_square_attacked(king_bb.bit_length() - 1, color.to_opponent())
+
+    def attackers_to(self, square: int, ignore_square: int = -1) -> int:
+        """square に利いている駒 (先手・後手とも) のビットボードを返す
+
+        ignore_square のマスは空いているものとして扱う (玉が動いた後の利きを調べるため)
+        """
+        return self._attackers_to(square, self.occupied, ignore_square, False)
+
+    def is_square_attacked(
+        self, square: int, by_color: Color, ignore_square: int = -1
+    ) -> bool:
+        """square に by_color の駒が利いているかどうかを返す"""
+        return (
+            self._attackers_to(square, self.color_bb[by_color], ignore_square, True)
+            != 0
+        )
+
+    def _attackers_to(self, square, attackers_bb, ignore_square, stop_at_first):
+        """square から外側に向かって、attackers_bb の駒のうち square に利いている駒を探す"""
+        board = self.board
+        occupied = self.occupied
+        if ignore_square >= 0:
+            occupied &= ~SQUARE_BB[ignore_square]
+        attackers_bb &= occupied
+        attackers = 0
+
+        # 8 方向: 各方向で最初にぶつかった駒が、逆向きの利きを持っていれば利いている
+        for ray, adjacent_attackers, long_attackers in SQUARE_RAYS[square]:
+            for square_from in ray:
+                bb = SQUARE_BB[square_from]
+                if not occupied & bb:
                     continue
-                for move_direction in piece_from.move_directions():
-                    max_distance = 8 if move_direction.is_long else 1
-                    file_to = file_from
-                    rank_to = rank_from
-                    for distance in range(max_distance):
-                        file_to += move_direction.direction.delta_file
-                        rank_to += move_direction.direction.delta_rank
-                        if not (
-                            0 <= file_to < Position.BOARD_SIZE
-                            and 0 <= rank_to < Position.BOARD_SIZE
-                        ):
-                            # 盤外に出たので何もしない
-                            continue
-
-                        piece_to = self.board[file_to][rank_to]
-                        if piece_to == king:
-                            return True
-                        if piece_to != Piece.NO_PIECE:
-                            # 王以外の駒がある
-                            break
-        return False
+                if attackers_bb & bb:
+                    piece = board[SQUARE_FILE[square_from]][SQUARE_RANK[square_from]]
+                    if square_from == ray[0]:
+                        is_attacker = adjacent_attackers[piece]
+                    else:
+                        is_attacker = long_attackers[piece]
+                    if is_attacker:
+                        attackers |= bb
+                        if stop_at_first:
+                            return attackers
+                break
+
+        # 桂馬の利き
+        for square_from, jump_attackers in SQUARE_JUMPS[square]:
+            bb = SQUARE_BB[square_from]
+            if not attackers_bb & bb:
+                continue
+            if jump_attackers[board[SQUARE_FILE[square_from]][SQUARE_RANK[square_from]]]:
+                attackers |= bb
+                if stop_at_first:
+                    return attackers
+        return attackers
@@ -0,0 +1,161 @@
+import os
+import sys
+import time
+
+import generate
+import move
+from evaluator import Evaluator
+from move import Move
+from position import Position
+
+# この環境変数が 1 なら起動時から計測する
+PROFILE_ENV = "SHOGI_PROFILE"
+# この環境変数にファイル名を指定すると、go の探索を cProfile で計測して書き出す
+PROFILE_FILE_ENV = "SHOGI_PROFILE_FILE"
+# エンジンのモジュールが置かれたディレクトリ (関数の参照を差し替えるのはこの下のモジュールだけ)
+ENGINE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def _targets():
+    """計測する関数の一覧 [(持ち主のモジュール・クラス, 属性名, 表示名), ...]
+
+    KPEvaluator.evaluate は中で Evaluator.evaluate を呼ぶので、同じ表示名にすると
+    1 回の評価が 2 回に数えられる。表示名は関数ごとに別にする
+    """
+    targets = [
+        (generate, "generate", "generate"),
+        (generate, "generate_legal", "generate_legal"),
+        (Position, "do_move", "do_move"),
+        (Position, "undo_move", "undo_move"),
+        (Position, "is_in_checked", "is_in_checked"),
+        (Evaluator, "evaluate", "evaluate"),
+        (Move, "from_usi_string", "Move.from_usi_string"),
+        (move, "move_from_usi_string", "move_from_usi_string"),
+    ]
+    kp_evaluator = sys.modules.get("kp_evaluator")
+    if kp_evaluator is not None:
+        targets.append((kp_evaluator.KPEvaluator, "evaluate", "kp_evaluate"))
+    return targets
+
+
+def _engine_modules():
+    """読み込み済みのモジュールのうち、ENGINE_DIR 直下のファイルから読み込んだもの"""
+    modules = []
+    for module in list(sys.modules.values()):
+        path = getattr(module, "__file__", None)
+        if path is not None and os.path.dirname(os.path.abspath(path)) == ENGINE_DIR:
+            modules.append(module)
+    return modules
+
+
+class Profiler:
+    """探索でよく呼ばれる関数の呼び出し回数と時間を数える
+
+    有効にしたときだけ関数を計測用のラッパーに差し替えるので、
+    無効のときは探索の速度に影響しない。時間は呼び出し先を含めた時間
+    (generate_legal の時間には中で呼ぶ generate の時間も含まれる)
+    """
+
+    enabled = False
+    stats = {}  # {表示名: [呼び出し回数, 合計時間 (秒)]}
+    _replaced = {}  # {元の関数: ラッパー}
+    _restore = []  # 無効にするときに戻す [(持ち主, 属性名, 元の属性), ...]
+
+    @staticmethod
+    def _wrap(function, name):
+        stat = Profiler.stats.setdefault(name, [0, 0.0])
+        perf_counter = time.perf_counter
+
+        def wrapper(*args, **kwargs):
+            start_time = perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                stat[0] += 1
+                stat[1] += perf_counter() - start_time
+
+        wrapper.__wrapped__ = function
+        return wrapper
+
+    @staticmethod
+    def enable(*objects) -> None:
+        """計測を始める
+
+        from ... import で取り込まれた関数や、objects の属性に入っている関数
+        (Searcher.evaluate など) もラッパーに差し替える
+        """
+        if Profiler.enabled:
+            return
+        for owner, attribute, name in _targets():
+            original = owner.__dict__[attribute]
+            function = original
+            if isinstance(original, staticmethod):
+                function = original.__func__
+            wrapper = Profiler._wrap(function, name)
+            Profiler._replaced[function] = wrapper
+            Profiler._restore.append((owner, attribute, original))
+            if isinstance(original, staticmethod):
+                setattr(owner, attribute, staticmethod(wrapper))
+            else:
+                setattr(owner, attribute, wrapper)
+        Profiler._replace_references(Profiler._replaced, objects)
+        Profiler.enabled = True
+
+    @staticmethod
+    def disable(*objects) -> None:
+        """計測をやめて、元の関数に戻す"""
+        if not Profiler.enabled:
+            return
+        for owner, attribute, original in reversed(Profiler._restore):
+            setattr(owner, attribute, original)
+        restored = {wrapper: function for function, wrapper in Profiler._replaced.items()}
+        Profiler._replace_references(restored, objects)
+        Profiler._replaced = {}
+        Profiler._restore = []
+        Profiler.enabled = False
+
+    @staticmethod
+    def _replace_references(mapping, objects) -> None:
+        """読み込み済みのエンジンのモジュールと objects の中で、mapping のキーの関数を値に置き換える
+
+        標準ライブラリや外部のパッケージのモジュールには触らない
+        """
+        namespaces = [vars(module) for module in _engine_modules()]
+        namespaces += [vars(obj) for obj in objects]
+        for namespace in namespaces:
+            for attribute, value in list(namespace.items()):
+                try:
+                    replacement = mapping.get(value)
+                except TypeError:
+                    # ハッシュできない値
+                    continue
+                if replacement is not None:
+                    namespace[attribute] = replacement
+
+    @staticmethod
+    def reset() -> None:
+        for stat in Profiler.stats.values():
+            stat[0] = 0
+            stat[1] = 0.0
+
+    @staticmethod
+    def summary() -> list[str]:
+        """計測結果を 1 関数 1 行の文字列で返す (合計時間の長い順)"""
+        lines = []
+        for name, (calls, seconds) in sorted(
+            Profiler.stats.items(), key=lambda item: -item[1][1]
+        ):
+            average = seconds / calls * 1e6 if calls else 0.0
+            lines.append(
+                f"{name}: calls {calls} time {int(seconds * 1000)} ms "
+                f"avg {average:.2f} us"
+            )
+        return lines
+
+    @staticmethod
+    def enabled_by_environment() -> bool:
+        return os.environ.get(PROFILE_ENV, "") not in {"", "0"}
+
+    @staticmethod
+    def profile_file_from_environment():
+        return os.environ.get(PROFILE_FILE_ENV) or None
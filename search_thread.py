@@ -0,0 +1,178 @@
+import cProfile
+import sys
+import threading
+import traceback
+
+from move import move_to_usi_string
+from time_manager import TimeManager
+from lazy_smp import LazySMP, select_best_move
+from mate_solver import MateSolver
+from searcher import VALUE_MATE, VALUE_MATE_IN_MAX_PLY
+
+# 探索スレッドとコマンドを読むスレッドの出力が混ざらないようにするロック
+_output_lock = threading.Lock()
+
+
+def send(line: str) -> None:
+    """USI の出力を 1 行送る"""
+    with _output_lock:
+        sys.stdout.write(line + "\n")
+        sys.stdout.flush()
+
+
+def score_to_usi(value: int) -> str:
+    """評価値を info の score の形式にする (詰みなら score mate 手数)"""
+    if value >= VALUE_MATE_IN_MAX_PLY:
+        return f"mate {VALUE_MATE - value}"
+    if value <= -VALUE_MATE_IN_MAX_PLY:
+        return f"mate -{VALUE_MATE + value}"
+    return f"cp {value}"
+
+
+class SearchThread:
+    """探索を別スレッドで行い、その間もコマンドに応答できるようにする"""
+
+    def __init__(self, searcher):
+        self.searcher = searcher
+        self.helpers = LazySMP()  # 他のプロセスで並列に探索するヘルパー
+        self.mate_solver = MateSolver()  # go mate で使う詰み探索
+        self.thread = None
+        self.time_manager = None
+        self.profile_file = None  # 指定すると go の探索を cProfile で計測して書き出す
+        # stop / ponderhit を受け取ったときに、bestmove を待たせているスレッドを起こす
+        self.wakeup = threading.Event()
+
+    def is_searching(self) -> bool:
+        return self.thread is not None and self.thread.is_alive()
+
+    def prepare(self) -> None:
+        """探索中でなければ、ヘルパープロセスを設定に合わせて用意する"""
+        if not self.is_searching():
+            self.helpers.prepare(self.searcher.tt)
+
+    def start(self, position, limits) -> None:
+        """探索を開始する。探索が終わるまで position を変更してはならない"""
+        self.wait()
+        self.helpers.prepare(self.searcher.tt)
+        self.time_manager = TimeManager(limits, position.side_to_move)
+        self.searcher.tt.new_search()
+        self.searcher.stop_requested = False
+        self.helpers.start_search(position, self.searcher.tt.generation)
+        self.wakeup.clear()
+        self.thread = threading.Thread(
+            target=self._run, args=(position, limits, self.time_manager), daemon=True
+        )
+        self.thread.start()
+
+    def start_mate(self, position, time_limit) -> None:
+        """詰み探索を開始する。time_limit (ミリ秒) が None なら stop が来るまで探索する"""
+        self.wait()
+        self.mate_solver.stop_requested = False
+        self.thread = threading.Thread(
+            target=self._run_mate, args=(position, time_limit), daemon=True
+        )
+        self.thread.start()
+
+    def stop(self) -> None:
+        """探索を打ち切り、bestmove を返させる"""
+        if not self.is_searching():
+            return
+        self.searcher.stop_requested = True
+        self.mate_solver.stop_requested = True
+        self.wakeup.set()
+        self.wait()
+
+    def ponderhit(self) -> None:
+        """先読みしていた指し手を相手が指したので、通常の探索に切り替える"""
+        if not self.is_searching():
+            return
+        self.time_manager.restart()
+        self.searcher.pondering = False
+        self.wakeup.set()
+
+    def quit(self) -> None:
+        self.stop()
+        self.helpers.close()
+
+    def wait(self) -> None:
+        """探索スレッドの終了を待つ"""
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def _run(self, position, limits, time_manager) -> None:
+        searcher = self.searcher
+        profile = None
+        if self.profile_file is not None:
+            # cProfile はスレッドごとに有効にする必要があるので、探索スレッドの中で始める
+            profile = cProfile.Profile()
+            profile.enable()
+        try:
+            best_move = None
+            for best_move in searcher.iterative_deepening(
+                position, limits, time_manager, limits.ponder
+            ):
+                self._send_info(best_move, time_manager)
+
+            # 先読み中と infinite のときは、stop か ponderhit が来るまで bestmove を返さない
+            while (searcher.pondering or limits.infinite) and not searcher.stop_requested:
+                self.wakeup.wait()
+                self.wakeup.clear()
+
+            # ヘルパーの結果も合わせて指し手を決める
+            helper_results = self.helpers.stop_search()
+            if helper_results:
+                best_move = select_best_move([best_move] + helper_results)
+                self._send_info(best_move, time_manager)
+
+            if best_move.value <= -VALUE_MATE_IN_MAX_PLY:
+                send("bestmove resign")
+            elif len(best_move.pv) >= 2:
+                send(
+                    f"bestmove {move_to_usi_string(best_move.move)} "
+                    f"ponder {move_to_usi_string(best_move.pv[1])}"
+                )
+            else:
+                send(f"bestmove {move_to_usi_string(best_move.move)}")
+        except Exception as e:
+            send(f"info string 探索中に例外が発生しました: {e}")
+            for traceback_line in traceback.format_exc().splitlines():
+                send(f"info string {traceback_line}")
+            send("bestmove resign")  # とりあえず投了してエンジンが落ちないようにする
+        finally:
+            self.helpers.stop_search()
+            if profile is not None:
+                profile.disable()
+                profile.dump_stats(self.profile_file)
+
+    def _run_mate(self, position, time_limit) -> None:
+        solver = self.mate_solver
+        try:
+            pv = solver.solve(position, time_limit)
+            elapsed = max(1, solver.elapsed())
+            send(
+                f"info nodes {solver.nodes} nps {solver.nodes * 1000 // elapsed} "
+                f"time {elapsed}"
+            )
+            if pv is not None:
+                send("checkmate " + " ".join(move_to_usi_string(move) for move in pv))
+            elif solver.stop:
+                send("checkmate timeout")
+            else:
+                send("checkmate nomate")
+        except Exception as e:
+            send(f"info string 詰み探索中に例外が発生しました: {e}")
+            for traceback_line in traceback.format_exc().splitlines():
+                send(f"info string {traceback_line}")
+            send("checkmate nomate")
+
+    def _send_info(self, best_move, time_manager) -> None:
+        time_ms = time_manager.elapsed()
+        nodes = self.searcher.nodes + self.helpers.nodes()
+        nps = nodes * 1000 // max(1, time_ms)
+        pv_string = " ".join(move_to_usi_string(move) for move in best_move.pv)
+        send(
+            f"info depth {best_move.depth} score {score_to_usi(best_move.value)} "
+            f"nodes {nodes} nps {nps} time {time_ms} "
+            f"hashfull {self.searcher.tt.hashfull()} pv {pv_string}"
+        )
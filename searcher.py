@@ -1,45 +1,258 @@
-from move import Move
-from generate import generate
+from move import MOVE_NONE, MOVE_PROMOTE, MOVE_RESIGN, move_to
+from generate import generate, generate_legal
 from evaluator import Evaluator
 from piece_types import Piece
+from bitboard import SQUARE_BB, SQUARE_FILE, SQUARE_RANK
+from transposition_table import BOUND_EXACT, BOUND_LOWER, BOUND_UPPER
+
+VALUE_INFINITE = 32000  # 評価値の最大値 (玉を取る指し手)
+MAX_PLY = 128  # 探索する最大手数
+CHECK_INTERVAL = 512  # 何局面ごとに思考時間などを確認するか (2 のべき乗)
+VALUE_MATE = 30000  # 詰みの評価値 (詰むまでの手数を引いた値を使う)
+VALUE_MATE_IN_MAX_PLY = VALUE_MATE - MAX_PLY  # これ以上の評価値は詰みを見つけたもの
+
+# Lazy SMP のヘルパーが反復深化で飛ばす深さ
+# ヘルパーごとに探索する深さをずらし、置換表を通して違う部分木を埋め合うようにする
+SKIP_SIZE = [1, 1, 2, 2, 2, 2, 3, 3, 3, 3, 3, 3, 4, 4, 4, 4, 4, 4, 4, 4]
+SKIP_PHASE = [0, 1, 0, 1, 2, 3, 0, 1, 2, 3, 4, 5, 0, 1, 2, 3, 4, 5, 6, 7]
+
+
+def value_to_tt(value, ply):
+    """詰みの評価値を、探索開始局面からではなくその局面からの手数に直して置換表に入れる"""
+    if value >= VALUE_MATE_IN_MAX_PLY:
+        return value + ply
+    if value <= -VALUE_MATE_IN_MAX_PLY:
+        return value - ply
+    return value
+
+
+def value_from_tt(value, ply):
+    """value_to_tt の逆"""
+    if value >= VALUE_MATE_IN_MAX_PLY:
+        return value - ply
+    if value <= -VALUE_MATE_IN_MAX_PLY:
+        return value + ply
+    return value
 
 
 class BestMove:
-    def __init__(self, move, value):
+    def __init__(self, move, value, pv=None, depth=0):
         self.move = move
         self.value = value
+        self.pv = pv if pv is not None else [move]  # 読み筋
+        self.depth = depth  # 探索した深さ
 
 
 class Searcher:
-    @staticmethod
-    def search(position, depth, nodes):
+    # 静止探索で駒を取らない成る手も調べるかどうか
+    QUIESCENCE_PROMOTIONS = False
+
+    def __init__(self, tt, thread_id=0):
+        self.tt = tt  # 置換表 (対局中の指し手をまたいで使い回す)
+        self.thread_id = thread_id  # 0 ならメイン、それ以外は Lazy SMP のヘルパー
+        self.evaluate = Evaluator.evaluate  # 末端で使う評価関数 (USI オプション EvalType)
+        self.nodes = 0  # 探索した局面数 (静止探索を含む)
+        self.qnodes = 0  # 静止探索で調べた局面数
+        self.pv_table = [[] for _ in range(MAX_PLY + 1)]  # 手数ごとの読み筋
+        self.limits = None  # 探索の制限
+        self.time_manager = None
+        self.completed_depth = 0  # 探索を終えた深さ
+        self.stop = False  # True になったら探索を打ち切る
+        # 以下は探索中に別スレッドから書き換える
+        self.stop_requested = False  # stop コマンドを受け取った
+        self.pondering = False  # 先読み中は時間による打ち切りをしない
+
+    def iterative_deepening(self, position, limits, time_manager, ponder=False):
+        """深さ 1 から反復深化で探索し、反復ごとに結果を返す
+
+        制限の深さまで探索するか、局面数・時間の制限に達するか、stop_requested が
+        立ったら終了する。途中で打ち切った反復の結果は返さない。
+        """
+        self.nodes = 0
+        self.qnodes = 0
+        self.limits = limits
+        self.time_manager = time_manager
+        self.completed_depth = 0
+        self.stop = False
+        self.pondering = ponder
+        max_depth = min(limits.depth or MAX_PLY, MAX_PLY)
+        for depth in range(1, max_depth + 1):
+            if self.thread_id > 0:
+                i = (self.thread_id - 1) % len(SKIP_SIZE)
+                if (depth + SKIP_PHASE[i]) // SKIP_SIZE[i] % 2 == 1:
+                    continue
+
+            value = self.search(position, depth, -VALUE_INFINITE, VALUE_INFINITE, 0)
+            if self.stop:
+                break
+            self.completed_depth = depth
+            pv = self.pv_table[0]
+            if not pv:
+                # 指せる手がない
+                yield BestMove(MOVE_RESIGN, value, [MOVE_RESIGN], depth)
+                return
+            yield BestMove(pv[0], value, list(pv), depth)
+
+            if abs(value) >= VALUE_MATE_IN_MAX_PLY and VALUE_MATE - abs(value) <= depth:
+                # この深さまでの全幅探索で詰みまで読み切ったので、深くしても結果は変わらない
+                break
+            if self.stop_requested:
+                break
+            if self.limits.nodes is not None and self.nodes >= self.limits.nodes:
+                break
+            if not self.pondering and not self.time_manager.can_start_next_iteration():
+                break
+
+    def check_stop(self) -> None:
+        """stop コマンドを受け取ったか、局面数・時間の制限に達していたら探索を打ち切る"""
+        if self.completed_depth == 0:
+            # 最低でも深さ 1 の探索は終える
+            return
+        if self.stop_requested:
+            self.stop = True
+        elif self.limits.nodes is not None and self.nodes >= self.limits.nodes:
+            self.stop = True
+        elif not self.pondering and self.time_manager.is_hard_limit_exceeded():
+            self.stop = True
+
+    def search(self, position, depth, alpha, beta, ply):
+        """PVS (principal variation search) による alpha-beta 探索"""
+        self.pv_table[ply] = []
+        if ply >= MAX_PLY:
+            return self.evaluate(position)
         if depth == 0:
-            return BestMove(None, Evaluator.evaluate(position))
+            return self.quiescence(position, alpha, beta, ply)
 
-        best_value = float("-inf")
-        best_move = Move.Resign
+        # 置換表に十分な深さの結果があればそれを返す (読み筋が途切れないよう null window のときのみ)
+        key = position.key
+        tt_entry = self.tt.probe(key)
+        tt_move = MOVE_NONE
+        if tt_entry is not None:
+            tt_move = tt_entry.move
+            tt_value = value_from_tt(tt_entry.score, ply)
+            if (
+                ply > 0
+                and beta - alpha == 1
+                and tt_entry.depth >= depth
+                and (
+                    (tt_entry.bound == BOUND_EXACT)
+                    or (tt_entry.bound == BOUND_LOWER and tt_value >= beta)
+                    or (tt_entry.bound == BOUND_UPPER and tt_value <= alpha)
+                )
+            ):
+                return tt_value
+
+        original_alpha = alpha
+        best_value = -VALUE_INFINITE
+        best_move = MOVE_NONE
+
+        moves = generate_legal(position)
+        if not moves:
+            # 詰み
+            return -VALUE_MATE + ply
+
+        # 置換表の最善手を最初に調べる
+        if tt_move in moves:
+            moves.remove(tt_move)
+            moves.insert(0, tt_move)
+
+        for i, move in enumerate(moves):
+            # 相手の玉を取る手なら、early return
+            square_to = move_to(move)
+            piece_to = position.board[SQUARE_FILE[square_to]][SQUARE_RANK[square_to]]
+            if piece_to in {Piece.BLACK_KING, Piece.WHITE_KING}:
+                self.pv_table[ply] = [move]
+                return VALUE_MATE - ply
+
+            self.nodes += 1
+            if self.nodes & (CHECK_INTERVAL - 1) == 0:
+                self.check_stop()
 
-        # 合法手を列挙
-        moves = list(generate(position))
-        ok_moves = []
-        for move in moves:
             position.do_move(move)
-            if not position.is_in_checked(position.side_to_move.to_opponent()):
-                ok_moves.append(move)
+            if i == 0:
+                value = -self.search(position, depth - 1, -beta, -alpha, ply + 1)
+            else:
+                # 2 手目以降は null window で最善手より悪いことを確かめ、そうでなければ再探索する
+                value = -self.search(position, depth - 1, -alpha - 1, -alpha, ply + 1)
+                if alpha < value < beta:
+                    value = -self.search(position, depth - 1, -beta, -alpha, ply + 1)
             position.undo_move(move)
 
+            if self.stop:
+                # 打ち切った探索の結果は使わない
+                return 0
+
+            if value > best_value:
+                best_value = value
+                best_move = move
+                if value > alpha:
+                    alpha = value
+                    self.pv_table[ply] = [move] + self.pv_table[ply + 1]
+                    if alpha >= beta:
+                        break
+
+        if best_value >= beta:
+            bound = BOUND_LOWER
+        elif best_value > original_alpha:
+            bound = BOUND_EXACT
+        else:
+            bound = BOUND_UPPER
+        self.tt.store(key, best_move, value_to_tt(best_value, ply), depth, bound)
+        return best_value
+
+    def quiescence(self, position, alpha, beta, ply):
+        """駒を取る指し手 (と成る指し手) だけを調べ、駒の取り合いが落ち着いた局面で評価する"""
+        self.pv_table[ply] = []
+        opponent = position.side_to_move.to_opponent()
+        if position.is_in_checked(opponent):
+            # 直前の指し手で自玉を取られる形にした (非合法手だった)
+            return VALUE_INFINITE
+        if ply >= MAX_PLY:
+            return self.evaluate(position)
+
+        in_check = position.is_in_checked(position.side_to_move)
+        if in_check:
+            # 王手されているときは評価値で打ち切らず、全ての王手回避を調べる
+            # 王手回避がなければ詰み
+            best_value = -VALUE_MATE + ply
+            moves = generate_legal(position)
+        else:
+            # 何も指さずに評価値で打ち切る (stand pat)
+            best_value = self.evaluate(position)
+            if best_value >= beta:
+                return best_value
+            if best_value > alpha:
+                alpha = best_value
+            if Searcher.QUIESCENCE_PROMOTIONS:
+                # generate は駒を取る指し手、駒を取らない成る指し手の順に返す
+                moves = []
+                for move in generate(position):
+                    if not (
+                        move & MOVE_PROMOTE
+                        or position.occupied & SQUARE_BB[move_to(move)]
+                    ):
+                        break
+                    moves.append(move)
+            else:
+                moves = generate(position, position.color_bb[opponent])
+
         for move in moves:
-            # 相手の玉を取る手なら、early return
-            if move.piece_to in {Piece.BLACK_KING, Piece.WHITE_KING}:
-                return BestMove(move, float("inf"))
+            self.nodes += 1
+            self.qnodes += 1
+            if self.nodes & (CHECK_INTERVAL - 1) == 0:
+                self.check_stop()
 
-            nodes += 1  # nodes をリストで渡してミュータブルに
             position.do_move(move)
-            child_best_move = Searcher.search(position, depth - 1, nodes)
+            value = -self.quiescence(position, -beta, -alpha, ply + 1)
             position.undo_move(move)
 
-            if best_value < -child_best_move.value:
-                best_value = -child_best_move.value
-                best_move = move
+            if self.stop:
+                return 0
 
-        return BestMove(best_move, best_value)
+            if value > best_value:
+                best_value = value
+                if value > alpha:
+                    alpha = value
+                    if alpha >= beta:
+                        break
+        return best_value
@@ -0,0 +1,321 @@
+import argparse
+import multiprocessing
+import os
+import queue
+import random
+import struct
+import sys
+import time
+
+from position import Position
+from piece_types import Color, Piece
+from generate import generate_legal
+from move import MOVE_RESIGN
+from searcher import Searcher
+from transposition_table import TranspositionTable
+from time_manager import SearchLimits, TimeManager
+
+# 教師局面のファイル
+# 1 レコード 104 バイト (リトルエンディアン) を書いた順に並べたもの
+#   盤面 81 バイト (マス番号 file * 9 + rank の順に Piece の値)
+#   持ち駒 14 バイト (先手の歩から飛車、後手の歩から飛車の枚数)
+#   手番 1 バイト (Color の値)
+#   評価値 2 バイト (符号付き、手番側から見た探索の評価値)
+#   最善手 2 バイト (整数で表した指し手)
+#   対局結果 1 バイト (符号付き、手番側から見て 1: 勝ち 0: 引き分け -1: 負け)
+#   1 バイト (未使用)
+#   手数 2 バイト
+TRAINING_RECORD = struct.Struct("<81s14sBhHbxH")
+HAND_PIECES = list(range(Piece.BLACK_PAWN, Piece.BLACK_KING)) + list(
+    range(Piece.WHITE_PAWN, Piece.WHITE_KING)
+)
+
+DEFAULT_DEPTH = 3  # 1 手あたりの探索深さ
+DEFAULT_RANDOM_PLY = 8  # 序盤にランダムに指す手数 (この間の局面は書き出さない)
+DEFAULT_MAX_PLY = 256  # この手数に達したら引き分け
+DEFAULT_EVAL_LIMIT = 3000  # 評価値の絶対値がこれを超えたら勝敗を付けて終局する
+REPETITION_COUNT = 4  # 同じ局面がこの回数現れたら千日手 (引き分け)
+FLUSH_RECORDS = 4096  # 何レコードたまったらファイルに書き出すか
+REPORT_INTERVAL = 10.0  # 進み具合を表示する間隔 (秒)
+
+
+def _position_bytes(position):
+    """局面の (盤面, 持ち駒) のバイト列"""
+    board = bytes(
+        position.board[square // Position.BOARD_SIZE][square % Position.BOARD_SIZE]
+        for square in range(Position.BOARD_SIZE * Position.BOARD_SIZE)
+    )
+    hand = bytes(position.hand_piece[piece] for piece in HAND_PIECES)
+    return board, hand
+
+
+def pack_position(position, score, move, result):
+    """局面と探索の結果を 1 レコードのバイト列にする"""
+    board, hand = _position_bytes(position)
+    return TRAINING_RECORD.pack(
+        board, hand, position.side_to_move, score, move, result, position.play
+    )
+
+
+def unpack_position(data, position):
+    """1 レコードから局面を設定し、(評価値, 最善手, 対局結果) を返す"""
+    board, hand, side_to_move, score, move, result, play = TRAINING_RECORD.unpack(data)
+    rows = []
+    for rank in range(Position.BOARD_SIZE):
+        row = ""
+        empty_sequence = 0
+        for file in range(Position.BOARD_SIZE - 1, -1, -1):
+            piece = Piece(board[file * Position.BOARD_SIZE + rank])
+            if piece == Piece.NO_PIECE:
+                empty_sequence += 1
+                continue
+            if empty_sequence > 0:
+                row += str(empty_sequence)
+                empty_sequence = 0
+            if piece != piece.as_unpromoted():
+                row += "+"
+            row += piece.as_unpromoted().to_char()
+        if empty_sequence > 0:
+            row += str(empty_sequence)
+        rows.append(row)
+    hand_string = ""
+    for piece, count in zip(HAND_PIECES, hand):
+        if count > 1:
+            hand_string += str(count)
+        if count > 0:
+            hand_string += Piece(piece).to_char()
+    side = "b" if side_to_move == Color.BLACK else "w"
+    position.set_position(f"{'/'.join(rows)} {side} {hand_string or '-'} {play}")
+    return score, move, result
+
+
+def read_records(path):
+    """教師局面のファイルから 1 レコードずつバイト列を返す"""
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(TRAINING_RECORD.size * FLUSH_RECORDS)
+            if not data:
+                break
+            for offset in range(0, len(data), TRAINING_RECORD.size):
+                yield data[offset : offset + TRAINING_RECORD.size]
+
+
+class SelfPlayWorker:
+    """1 プロセス分の自己対局を指し、教師局面を自分のシャードファイルに書き出す"""
+
+    def __init__(
+        self,
+        path,
+        depth=DEFAULT_DEPTH,
+        nodes=None,
+        random_ply=DEFAULT_RANDOM_PLY,
+        max_ply=DEFAULT_MAX_PLY,
+        eval_limit=DEFAULT_EVAL_LIMIT,
+        eval_file=None,
+        hash_mb=TranspositionTable.DEFAULT_SIZE_MB,
+        seed=None,
+    ):
+        self.path = path
+        self.depth = depth
+        self.nodes = nodes
+        self.random_ply = random_ply
+        self.max_ply = max_ply
+        self.eval_limit = eval_limit
+        self.rng = random.Random(seed)
+        self.position = Position()
+        self.searcher = Searcher(TranspositionTable(hash_mb))
+        self.weights = None
+        if eval_file is not None:
+            # NumPy が必要なので、使うときだけ読み込む
+            from kp_evaluator import KPEvaluator, KPWeights
+
+            self.weights = KPWeights.load(eval_file)
+            self.searcher.evaluate = KPEvaluator.evaluate
+        self.buffer = []
+        self.num_records = 0
+
+    def play_game(self) -> None:
+        """1 局指し、手番側から見た対局結果を付けて局面をバッファに入れる"""
+        position = self.position
+        position.set_position(Position.start_position_sfen)
+        if self.weights is not None:
+            from kp_evaluator import KPAccumulator
+
+            position.accumulator = KPAccumulator(self.weights, position)
+        self.searcher.tt.clear()
+
+        # 序盤はランダムに指して局面をばらけさせる
+        for _ in range(self.random_ply):
+            moves = generate_legal(position)
+            if not moves:
+                return
+            position.do_move(self.rng.choice(moves))
+
+        # 対局結果は終局するまで分からないので、レコードの材料をためておく
+        game_records = []
+        winner = None
+        while position.play <= self.max_ply:
+            if not generate_legal(position):
+                winner = position.side_to_move.to_opponent()
+                break
+            if position.key_history.count(position.key) >= REPETITION_COUNT - 1:
+                break
+            best = self._search()
+            if best is None or best.move == MOVE_RESIGN:
+                winner = position.side_to_move.to_opponent()
+                break
+            if abs(best.value) >= self.eval_limit:
+                side = position.side_to_move
+                winner = side if best.value > 0 else side.to_opponent()
+                break
+            board, hand = _position_bytes(position)
+            game_records.append(
+                (board, hand, position.side_to_move, best.value, best.move, position.play)
+            )
+            position.do_move(best.move)
+
+        for board, hand, side_to_move, score, move, play in game_records:
+            if winner is None:
+                result = 0
+            else:
+                result = 1 if winner == side_to_move else -1
+            self.buffer.append(
+                TRAINING_RECORD.pack(board, hand, side_to_move, score, move, result, play)
+            )
+        self.num_records += len(game_records)
+        if len(self.buffer) >= FLUSH_RECORDS:
+            self.flush()
+
+    def _search(self):
+        """決まった深さ (または局面数) まで探索し、最後の反復の結果を返す"""
+        limits = SearchLimits()
+        limits.depth = self.depth
+        limits.nodes = self.nodes
+        self.searcher.tt.new_search()
+        best = None
+        for best in self.searcher.iterative_deepening(
+            self.position, limits, TimeManager(limits, self.position.side_to_move)
+        ):
+            pass
+        return best
+
+    def flush(self) -> None:
+        """バッファのレコードをシャードファイルに追記する"""
+        if not self.buffer:
+            return
+        with open(self.path, "ab") as f:
+            f.write(b"".join(self.buffer))
+        self.buffer = []
+
+
+def _worker(worker_id, path, num_positions, options, progress):
+    """子プロセスで num_positions 局面以上になるまで自己対局し、進み具合を progress に送る"""
+    worker = SelfPlayWorker(path, seed=options["seed"] + worker_id, **options["worker"])
+    start_time = time.perf_counter()
+    while worker.num_records < num_positions:
+        worker.play_game()
+        progress.put((worker_id, worker.num_records, time.perf_counter() - start_time))
+    worker.flush()
+    progress.put((worker_id, None, time.perf_counter() - start_time))
+
+
+def generate_data(
+    output_prefix,
+    num_positions,
+    processes=1,
+    seed=0,
+    output=print,
+    **worker_options,
+):
+    """自己対局で教師局面を作る
+
+    プロセスごとに output_prefix.<番号>.bin へ書き出すので、プロセス間で書き込みを
+    調整する必要がない。REPORT_INTERVAL 秒ごとに 1 秒あたりの局面数を表示する
+    """
+    context = multiprocessing.get_context("spawn")
+    progress = context.Queue()
+    options = {"seed": seed, "worker": worker_options}
+    per_worker = (num_positions + processes - 1) // processes
+    workers = []
+    for worker_id in range(processes):
+        path = f"{output_prefix}.{worker_id}.bin"
+        worker = context.Process(
+            target=_worker, args=(worker_id, path, per_worker, options, progress)
+        )
+        worker.start()
+        workers.append(worker)
+
+    counts = [0] * processes
+    elapsed = [0.0] * processes
+    running = processes
+    start_time = time.perf_counter()
+    last_report = start_time
+    while running > 0:
+        try:
+            worker_id, count, seconds = progress.get(timeout=REPORT_INTERVAL)
+            elapsed[worker_id] = seconds
+            if count is None:
+                running -= 1
+            else:
+                counts[worker_id] = count
+        except queue.Empty:
+            if not any(worker.is_alive() for worker in workers):
+                break
+        now = time.perf_counter()
+        if now - last_report >= REPORT_INTERVAL or running == 0:
+            last_report = now
+            _report(counts, elapsed, now - start_time, output)
+    for worker in workers:
+        worker.join()
+    return sum(counts)
+
+
+def _report(counts, elapsed, total_elapsed, output) -> None:
+    total = sum(counts)
+    per_core = [
+        count / seconds for count, seconds in zip(counts, elapsed) if seconds > 0
+    ]
+    average = sum(per_core) / len(per_core) if per_core else 0.0
+    output(
+        f"positions {total} time {int(total_elapsed * 1000)} "
+        f"pps {int(total / total_elapsed) if total_elapsed > 0 else 0} "
+        f"pps/core {int(average)}"
+    )
+
+
+def main():
+    """自己対局で教師局面を作る
+
+    python selfplay.py -o data/train --positions 1000000 --depth 3 --processes 8
+    """
+    parser = argparse.ArgumentParser(description="自己対局による教師局面の生成")
+    parser.add_argument("-o", "--output", default="train", help="シャードファイルの名前の先頭")
+    parser.add_argument("--positions", type=int, default=100000, help="作る局面数")
+    parser.add_argument("--depth", type=int, default=DEFAULT_DEPTH)
+    parser.add_argument("--nodes", type=int, default=None)
+    parser.add_argument("--random-ply", type=int, default=DEFAULT_RANDOM_PLY)
+    parser.add_argument("--max-ply", type=int, default=DEFAULT_MAX_PLY)
+    parser.add_argument("--eval-limit", type=int, default=DEFAULT_EVAL_LIMIT)
+    parser.add_argument("--eval-file", default=None, help="KP 評価関数の重みファイル")
+    parser.add_argument("--hash", type=int, default=TranspositionTable.DEFAULT_SIZE_MB)
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    generate_data(
+        args.output,
+        args.positions,
+        args.processes,
+        args.seed,
+        depth=args.depth,
+        nodes=args.nodes,
+        random_ply=args.random_ply,
+        max_ply=args.max_ply,
+        eval_limit=args.eval_limit,
+        eval_file=args.eval_file,
+        hash_mb=args.hash,
+    )
+    sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
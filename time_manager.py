@@ -0,0 +1,128 @@
+import time
+
+from piece_types import Color
+
+
+class SearchLimits:
+    """go コマンドで指定された探索の制限"""
+
+    DEFAULT_DEPTH = 4  # 制限が何も指定されなかったときの探索深さ
+
+    def __init__(self):
+        self.time = [0, 0]  # 手番ごとの残り時間 (ミリ秒)
+        self.inc = [0, 0]  # 手番ごとの 1 手ごとの加算時間 (ミリ秒)
+        self.byoyomi = 0  # 秒読み (ミリ秒)
+        self.movetime = None  # 1 手の思考時間 (ミリ秒)
+        self.nodes = None  # 探索する局面数の上限
+        self.depth = None  # 探索する深さの上限
+        self.infinite = False  # stop が来るまで探索する
+        self.ponder = False  # 相手の手番中に先読みする
+
+    @staticmethod
+    def from_go_command(line):
+        """go [ponder] [btime x] [wtime x] [binc x] [winc x] [byoyomi x]
+        [movetime x] [nodes x] [depth x] [infinite] をパースする"""
+        limits = SearchLimits()
+        tokens = line.split()
+        index = 1
+        while index < len(tokens):
+            token = tokens[index]
+            index += 1
+            if token == "infinite":
+                limits.infinite = True
+                continue
+            if token == "ponder":
+                limits.ponder = True
+                continue
+            if index >= len(tokens):
+                break
+            value = int(tokens[index])
+            index += 1
+            match token:
+                case "btime":
+                    limits.time[Color.BLACK] = value
+                case "wtime":
+                    limits.time[Color.WHITE] = value
+                case "binc":
+                    limits.inc[Color.BLACK] = value
+                case "winc":
+                    limits.inc[Color.WHITE] = value
+                case "byoyomi":
+                    limits.byoyomi = value
+                case "movetime":
+                    limits.movetime = value
+                case "nodes":
+                    limits.nodes = value
+                case "depth":
+                    limits.depth = value
+
+        if not limits.infinite and not limits.use_time_management():
+            if limits.movetime is None and limits.nodes is None and limits.depth is None:
+                limits.depth = SearchLimits.DEFAULT_DEPTH
+        return limits
+
+    def use_time_management(self) -> bool:
+        """持ち時間に応じて思考時間を決めるかどうか"""
+        return any(self.time) or any(self.inc) or self.byoyomi > 0
+
+
+class TimeManager:
+    """1 手の思考時間を決め、探索を打ち切るかどうかを判定する"""
+
+    NETWORK_DELAY = 120  # 通信の遅延などを見込んで残しておく時間 (ミリ秒)
+    MOVES_TO_GO = 40  # 残り時間を何手で使い切るつもりで配分するか
+    MAXIMUM_RATIO = 4  # 目安の思考時間に対する最大の思考時間の倍率
+
+    def __init__(self, limits, side_to_move):
+        self.start_time = time.time()
+        self.soft_limit = None  # これを過ぎたら次の反復を始めない (ミリ秒)
+        self.hard_limit = None  # これを過ぎたら探索を打ち切る (ミリ秒)
+        self.use_full_time = False  # hard_limit まで反復を続けるかどうか
+
+        if limits.infinite:
+            return
+
+        if limits.movetime is not None:
+            self.soft_limit = self.hard_limit = max(
+                1, limits.movetime - TimeManager.NETWORK_DELAY
+            )
+            self.use_full_time = True
+            return
+
+        if not limits.use_time_management():
+            return
+
+        remaining = limits.time[side_to_move]
+        inc = limits.inc[side_to_move]
+        byoyomi = limits.byoyomi
+        # 使える時間の上限
+        maximum = max(1, remaining + inc + byoyomi - TimeManager.NETWORK_DELAY)
+
+        if remaining <= TimeManager.NETWORK_DELAY and byoyomi > 0:
+            # 秒読みに入っていたら、秒読みは使わないと失われるので使い切る
+            self.soft_limit = self.hard_limit = maximum
+            self.use_full_time = True
+            return
+
+        optimum = remaining // TimeManager.MOVES_TO_GO + inc + byoyomi
+        self.soft_limit = min(optimum, maximum)
+        self.hard_limit = min(optimum * TimeManager.MAXIMUM_RATIO, maximum)
+
+    def restart(self) -> None:
+        """思考時間の計測をやり直す (ponderhit を受け取ったとき)"""
+        self.start_time = time.time()
+
+    def elapsed(self) -> int:
+        """探索開始からの経過時間 (ミリ秒)"""
+        return int((time.time() - self.start_time) * 1000)
+
+    def is_hard_limit_exceeded(self) -> bool:
+        return self.hard_limit is not None and self.elapsed() >= self.hard_limit
+
+    def can_start_next_iteration(self) -> bool:
+        if self.soft_limit is None:
+            return True
+        if self.use_full_time:
+            return self.elapsed() < self.hard_limit
+        # 次の反復は今の反復より何倍も時間がかかるので、目安の時間の半分を過ぎたら始めない
+        return self.elapsed() * 2 < self.soft_limit
@@ -0,0 +1,151 @@
+import multiprocessing
+
+# 置換表
+# エントリは Python のオブジェクトではなく、確保済みのバッファに 64 ビット整数 2 つ
+# (ハッシュキーとデータの排他的論理和、データ) として詰めて格納する
+# Lazy SMP のヘルパーと共有しているときはキーとデータを別々に書き込むので、他のプロセスが
+# 書き込み途中のエントリを読むことがある。キーをデータとの排他的論理和で持っておけば、
+# 食い違った組はキーが一致しないので、別の局面のエントリとして使われることはない
+#   データ bit  0-15: 最善手 (整数で表した指し手)
+#          bit 16-23: 残り深さ
+#          bit 24-25: 評価値の種類 (BOUND_*)
+#          bit 26-31: 世代
+#          bit 32-63: 評価値 (SCORE_OFFSET を足して符号なしにしたもの)
+
+# 評価値の種類
+BOUND_NONE = 0
+BOUND_UPPER = 1  # 評価値は上界 (fail low)
+BOUND_LOWER = 2  # 評価値は下界 (fail high)
+BOUND_EXACT = BOUND_UPPER | BOUND_LOWER  # 正確な評価値
+
+CLUSTER_SIZE = 4  # 1 バケットに入るエントリ数
+ENTRY_WORDS = 2  # 1 エントリの 64 ビット整数の個数
+ENTRY_BYTES = ENTRY_WORDS * 8
+CLUSTER_BYTES = CLUSTER_SIZE * ENTRY_BYTES
+
+GENERATION_MASK = 0x3F
+SCORE_OFFSET = 1 << 31
+
+
+class TTEntry:
+    """probe の結果"""
+
+    def __init__(self, move, score, depth, bound):
+        self.move = move
+        self.score = score
+        self.depth = depth
+        self.bound = bound
+
+
+class TranspositionTable:
+    DEFAULT_SIZE_MB = 16
+
+    def __init__(self, size_mb=DEFAULT_SIZE_MB, shared=False):
+        self.generation = 0
+        self.resize(size_mb, shared)
+
+    def resize(self, size_mb: int, shared: bool = None) -> None:
+        """size_mb メガバイトの置換表を確保し直す (内容は消える)
+
+        shared が True なら、子プロセスに渡して共有できる共有メモリに確保する。
+        None なら今の設定のままにする。
+        """
+        if shared is not None:
+            self.shared = shared
+        self.size_mb = size_mb
+        num_clusters = max(1, size_mb * 1024 * 1024 // CLUSTER_BYTES)
+        if self.shared:
+            self._set_buffer(multiprocessing.RawArray("B", num_clusters * CLUSTER_BYTES))
+        else:
+            self._set_buffer(bytearray(num_clusters * CLUSTER_BYTES))
+
+    @staticmethod
+    def attach(buffer):
+        """他のプロセスで確保された共有メモリ上の置換表を使う"""
+        tt = TranspositionTable.__new__(TranspositionTable)
+        tt.generation = 0
+        tt.shared = True
+        tt.size_mb = len(buffer) // (1024 * 1024)
+        tt._set_buffer(buffer)
+        return tt
+
+    def _set_buffer(self, buffer) -> None:
+        self.buffer = buffer
+        self.num_clusters = len(buffer) // CLUSTER_BYTES
+        self.table = memoryview(buffer).cast("B").cast("Q")
+
+    def clear(self) -> None:
+        self.table.cast("B")[:] = bytes(self.num_clusters * CLUSTER_BYTES)
+        self.generation = 0
+
+    def new_search(self) -> None:
+        """go のたびに呼び、世代を進める"""
+        self.generation = (self.generation + 1) & GENERATION_MASK
+
+    def _cluster_index(self, key: int) -> int:
+        # キーの最下位ビットは手番なので、それより上のビットでバケットを決める
+        return (key >> 1) % self.num_clusters * CLUSTER_SIZE * ENTRY_WORDS
+
+    def probe(self, key: int):
+        """局面のエントリを探す。見つからなければ None を返す"""
+        table = self.table
+        index = self._cluster_index(key)
+        for i in range(index, index + CLUSTER_SIZE * ENTRY_WORDS, ENTRY_WORDS):
+            data = table[i + 1]
+            if table[i] ^ data == key and data != 0:
+                # 参照されたエントリは現在の世代にしておく
+                new_data = (data & ~(GENERATION_MASK << 26)) | (self.generation << 26)
+                table[i] = key ^ new_data
+                table[i + 1] = new_data
+                return TTEntry(
+                    data & 0xFFFF,
+                    (data >> 32) - SCORE_OFFSET,
+                    (data >> 16) & 0xFF,
+                    (data >> 24) & 0x3,
+                )
+        return None
+
+    def store(self, key: int, move: int, score: int, depth: int, bound: int) -> None:
+        table = self.table
+        index = self._cluster_index(key)
+        generation = self.generation
+
+        # 同じ局面のエントリか空きエントリがあればそこに書き込む
+        # なければ、浅い探索のものほど、古い世代のものほど置き換える
+        replace = index
+        replace_value = None
+        for i in range(index, index + CLUSTER_SIZE * ENTRY_WORDS, ENTRY_WORDS):
+            data = table[i + 1]
+            entry_key = table[i] ^ data
+            if entry_key == key or data == 0:
+                if entry_key == key and move == 0:
+                    # 最善手が分からないときは前の最善手を残す
+                    move = data & 0xFFFF
+                replace = i
+                break
+            age = (generation - (data >> 26)) & GENERATION_MASK
+            value = ((data >> 16) & 0xFF) - 8 * age
+            if replace_value is None or value < replace_value:
+                replace = i
+                replace_value = value
+
+        data = (
+            move
+            | (max(0, min(depth, 0xFF)) << 16)
+            | (bound << 24)
+            | (generation << 26)
+            | ((score + SCORE_OFFSET) << 32)
+        )
+        table[replace] = key ^ data
+        table[replace + 1] = data
+
+    def hashfull(self) -> int:
+        """先頭 1000 バケット分のエントリのうち現在の世代のものの割合 (千分率)"""
+        table = self.table
+        num_clusters = min(1000, self.num_clusters)
+        count = 0
+        for i in range(0, num_clusters * CLUSTER_SIZE * ENTRY_WORDS, ENTRY_WORDS):
+            data = table[i + 1]
+            if data != 0 and (data >> 26) & GENERATION_MASK == self.generation:
+                count += 1
+        return count * 1000 // (num_clusters * CLUSTER_SIZE)
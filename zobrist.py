@@ -0,0 +1,32 @@
+import random
+
+from piece_types import Piece
+from bitboard import SQUARE_NB
+
+# 局面のハッシュキー (Zobrist ハッシュ) に使う乱数表
+# 同じ局面がプロセスをまたいでも同じキーになるよう、固定のシードで生成する
+_random = random.Random(20240401)
+
+# 手番 (後手番のときに XOR する)
+# 盤面・持ち駒の乱数は最下位ビットを 0 にしておき、キーの最下位ビットで手番が分かるようにする
+ZOBRIST_SIDE = 1
+
+MAX_HAND_COUNT = 18  # 同じ駒を持ち駒にできる最大枚数 (歩)
+
+
+def _random_key():
+    return _random.getrandbits(64) & ~ZOBRIST_SIDE
+
+
+# 盤上の駒 [駒][マス]
+ZOBRIST_BOARD = [
+    [0 if piece == Piece.NO_PIECE else _random_key() for _ in range(SQUARE_NB)]
+    for piece in range(Piece.NUM_PIECES)
+]
+
+# 持ち駒 [駒][枚数]
+# n 枚目を持ち駒に加えるときに [駒][n] を XOR する
+ZOBRIST_HAND = [
+    [0] + [_random_key() for _ in range(MAX_HAND_COUNT)]
+    for _ in range(Piece.NUM_PIECES)
+]